@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+#coding=utf-8
+
+"""
+Compare per-contact and joint (concatenated contacts) PCA features on
+simulated tetrode spikes: time needed to calculate the features and
+fraction of spikes closer to the centre of their own cell than to any
+other (in the space of normalised features).
+"""
+
+import time
+import numpy as np
+
+import spike_sort as sort
+
+def simulate_tetrode(n_spikes=20000, n_pts=32, n_cells=3, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.linspace(-1, 3, n_pts)
+    shape = np.exp(-t**2*4)-0.4*np.exp(-(t-1)**2)
+
+    #cells differ mainly by the distribution of amplitude on contacts
+    footprints = rng.uniform(0.5, 1.5, (n_cells, 4))
+    labels = rng.randint(0, n_cells, n_spikes)
+    amps = footprints[labels]*rng.uniform(0.9, 1.1, (n_spikes, 1))
+    spikes = shape[:, np.newaxis, np.newaxis]*amps[np.newaxis, :, :]
+
+    #noise correlated between contacts
+    mixing = 0.15*(np.eye(4)+0.5)
+    noise = np.dot(rng.randn(n_pts, n_spikes, 4), mixing)
+    return {'data': (spikes+noise).astype(np.float32)}, labels
+
+def centroid_accuracy(features, labels):
+    data = sort.features.normalize(features)['data']
+    centres = np.array([data[labels==l].mean(0) for l in np.unique(labels)])
+    dist = ((data[:, np.newaxis, :]-centres[np.newaxis, :, :])**2).sum(2)
+    return np.mean(dist.argmin(1)==labels)
+
+if __name__ == "__main__":
+
+    sp_waves, labels = simulate_tetrode()
+
+    for joint, ncomps in [(False, 1), (False, 2), (True, 4), (True, 8)]:
+        t_start = time.time()
+        pcs = sort.features.fetPCs(sp_waves, ncomps=ncomps, joint=joint)
+        elapsed = time.time()-t_start
+        print "%-12s %d features: %.3f s, accuracy %.3f" % (
+                "joint" if joint else "per-contact", pcs['data'].shape[1],
+                elapsed, centroid_accuracy(pcs, labels))
@@ -13,15 +13,19 @@ from spike_sort.ui import plotting
 from spike_sort.ui import zoomer
 from spike_analysis import dashboard
 import numpy as np
+import time
+import zlib
 
 class GenericSource(base.Component):
     
-    def __init__(self, dataset, overwrite=False, f_filter=None):
+    def __init__(self, dataset, overwrite=False, f_filter=None,
+                 lazy_filter=False):
         self.dataset = dataset
         self._signal = None
         self._events = None
         self.overwrite = overwrite
         self.f_filter = f_filter
+        self.lazy_filter = lazy_filter
         super(GenericSource, self).__init__()
         
     def read_signal(self):
@@ -29,7 +33,8 @@ class GenericSource(base.Component):
             self._signal = self.read_sp(self.dataset)
             if self.f_filter is not None:
                 filter = sort.extract.Filter(*self.f_filter)
-                self._signal = sort.extract.filter_proxy(self._signal, filter)
+                self._signal = sort.extract.filter_proxy(self._signal, filter,
+                                                    lazy=self.lazy_filter)
         return self._signal
     
     def read_events(self, cell):
@@ -51,15 +56,19 @@ class GenericSource(base.Component):
 
 class BakerlabSource(GenericSource, BakerlabFilter):  
     
-    def __init__(self, conf_file, dataset, overwrite=False, f_filter=None):
-        GenericSource.__init__(self, dataset, overwrite, f_filter)
+    def __init__(self, conf_file, dataset, overwrite=False, f_filter=None,
+                 lazy_filter=False):
+        GenericSource.__init__(self, dataset, overwrite, f_filter,
+                               lazy_filter)
         BakerlabFilter.__init__(self, conf_file)
 
 class PyTablesSource(GenericSource, PyTablesFilter):
     #TODO: add unit test
     
-    def __init__(self, h5file, dataset, overwrite=False, f_filter=None):
-        GenericSource.__init__(self, dataset, overwrite, f_filter)
+    def __init__(self, h5file, dataset, overwrite=False, f_filter=None,
+                 lazy_filter=False):
+        GenericSource.__init__(self, dataset, overwrite, f_filter,
+                               lazy_filter)
         PyTablesFilter.__init__(self, h5file)
         
 class NoMeanSource(object):
@@ -115,7 +124,17 @@ class NoMeanSource(object):
         print '... done'
  
 class SpikeDetector(base.Component):
-    """Detect Spikes with alignment"""
+    """Detect Spikes with alignment
+    
+    If `whiten` is True, spikes are first detected in the original
+    signal with `whiten_thresh` (in units of the original signal or
+    'auto' to estimate it from the median absolute deviation of
+    noise) to estimate noise covariance between contacts from
+    spike-free segments, and then detected again in the whitened
+    signal with `thresh` (in units of the whitened noise, i.e. noise
+    standard deviations). The fitted transform is stored in
+    `whitening`.
+    """
     waveform_src = base.RequiredFeature("SignalSource", 
                                         base.HasAttributes("signal"))
 
@@ -125,8 +144,18 @@ class SpikeDetector(base.Component):
                  resample=1, 
                  sp_win=(-0.2, 0.8),
                  f_filter=None,
-                 align=True):
+                 align=True,
+                 lazy_filter=False,
+                 thresh_method='std',
+                 thresh_window=None,
+                 whiten=False,
+                 whiten_thresh='auto'):
         self._thresh = thresh
+        self.whiten = whiten
+        self.whiten_thresh = whiten_thresh
+        self.whitening = None
+        self.thresh_method = thresh_method
+        self.thresh_window = thresh_window
         self.contact = contact
         self.type = type
         self.align = align
@@ -134,6 +163,7 @@ class SpikeDetector(base.Component):
         self.sp_win = sp_win
         self.sp_times = None
         self.f_filter = f_filter
+        self.lazy_filter = lazy_filter
         self._est_thresh = None
         super(SpikeDetector, self).__init__()
     
@@ -156,11 +186,22 @@ class SpikeDetector(base.Component):
             filter = None
         else:
             filter = sort.extract.Filter(*self.f_filter)
-            sp = sort.extract.filter_proxy(sp, filter)
+            sp = sort.extract.filter_proxy(sp, filter, lazy=self.lazy_filter)
+        if self.whiten:
+            spt = sort.extract.detect_spikes(sp,   edge=self.type,
+                                                   contact=self.contact,
+                                                   thresh=self.whiten_thresh,
+                                                   filter=filter,
+                                                   thresh_method='mad')
+            self.whitening = sort.extract.Whitening().fit(sp, spt, 
+                                                          self.sp_win)
+            sp = self.whitening.whiten_signal(sp)
         spt = sort.extract.detect_spikes(sp,   edge=self.type,
                                                contact=self.contact,
                                                thresh=self._thresh,
-                                               filter=filter)
+                                               filter=filter,
+                                               thresh_method=self.thresh_method,
+                                               thresh_window=self.thresh_window)
         self._est_thresh = spt['thresh']
         if self.align:
             self.sp_times = sort.extract.align_spikes(sp, spt, 
@@ -187,15 +228,17 @@ class SpikeExtractor(base.Component):
     spike_times = base.RequiredFeature("SpikeMarkerSource", 
                                     base.HasAttributes("events"))
     
-    def __init__(self, sp_win=[-0.2,0.8]):
+    def __init__(self, sp_win=[-0.2,0.8], out=None):
         self._sp_shapes = None
         self.sp_win = sp_win
+        self.out = out
         super(SpikeExtractor, self).__init__()
     
     def _extract_spikes(self):
         sp = self.waveform_src.signal
         spt = self.spike_times.events
-        self._sp_shapes = sort.extract.extract_spikes(sp, spt, self.sp_win)
+        self._sp_shapes = sort.extract.extract_spikes(sp, spt, self.sp_win,
+                                                      out=self.out)
     
     def read_spikes(self):
         if self._sp_shapes is None:
@@ -207,26 +250,110 @@ class SpikeExtractor(base.Component):
     
     spikes = property(read_spikes)
     
+def _checksum(arr, blocksize=10000):
+    """Shape, type and checksums of an array; the data are read in
+    blocks along the second axis (spikes of waveshapes), so that
+    arrays stored on disk are not loaded at once"""
+    crc, adler = 0, 1
+    if arr.ndim < 2:
+        blocks = [arr]
+    else:
+        blocks = (arr[:, i:i+blocksize] 
+                  for i in range(0, arr.shape[1], blocksize))
+    for block in blocks:
+        block = np.ascontiguousarray(block)
+        crc, adler = zlib.crc32(block, crc), zlib.adler32(block, adler)
+    return (arr.shape, arr.dtype.str, crc, adler)
+
+def _freeze(obj):
+    """Hashable representation of feature arguments (arrays are
+    represented by their checksums, other objects, such as fitted
+    models, by their identity and the state of their attributes)"""
+    if isinstance(obj, np.ndarray):
+        return ('ndarray',) + _checksum(obj)
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(v) for v in obj)
+    if hasattr(obj, '__dict__') and not callable(obj):
+        return ('object', id(obj), _freeze(vars(obj)))
+    return obj
+
+def _cache_key(method):
+    """Cache key of a feature method or None if its arguments can not
+    be fingerprinted"""
+    name, args, kwargs = method
+    key = (name, _freeze(args), _freeze(kwargs))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
 class FeatureExtractor(base.Component):
     spikes_src = base.RequiredFeature("SpikeSource", 
                                       base.HasAttributes("spikes"))
     
-    def __init__(self, normalize=True):
+    def __init__(self, normalize=True, whitening=None, blocksize=10000):
         self.feature_methods = []
         self._feature_data = None
+        self._cache = {}
+        self._cache_version = None
         self.normalize = normalize
+        self.whitening = whitening
+        self.blocksize = blocksize
         super(FeatureExtractor, self).__init__()
         
     def add_feature(self, name, *args, **kwargs):
-        func_name = "fet" + name
-        _func = features.__getattribute__(func_name)
-        func = lambda x: _func(x, *args, **kwargs)
-        self.feature_methods.append(func)
+        #check that the feature exists
+        features.__getattribute__("fet" + name)
+        self.feature_methods.append((name, args, kwargs))
+        self._feature_data = None
+    
+    def remove_feature(self, name):
+        """Remove all features called `name` (without the `fet`
+        prefix)"""
+        self.feature_methods = [m for m in self.feature_methods 
+                                if m[0] != name]
+        self._feature_data = None
+    
+    def _spikes_version(self, spikes):
+        """Fingerprint of the waveshapes (and of the whitening
+        transform) the features are calculated from"""
+        arrays = [spikes['data']]
+        if self.whitening is not None:
+            arrays += [self.whitening.W, self.whitening.W_temporal]
+        return tuple(None if arr is None else _checksum(arr, self.blocksize)
+                     for arr in arrays)
     
     def _calc_features(self):
         spikes = self.spikes_src.spikes
-        feats = [f(spikes) for f in self.feature_methods]
-        self._feature_data = features.combine(feats, norm=self.normalize)
+        version = self._spikes_version(spikes)
+        if version != self._cache_version:
+            self._cache = {}
+            self._cache_version = version
+        
+        keys = [_cache_key(m) for m in self.feature_methods]
+        feats = [self._cache.get(k) if k is not None else None 
+                 for k in keys]
+        missing = [i for i, f in enumerate(feats) if f is None]
+        if missing:
+            if self.whitening is not None:
+                spikes = self.whitening.whiten_spikes(spikes)
+            new_feats = features.calc_features(spikes, 
+                                    [self.feature_methods[i] for i in missing],
+                                    blocksize=self.blocksize,
+                                    split=True)
+            for i, feat in zip(missing, new_feats):
+                feats[i] = feat
+        #forget features which were removed (or can not be cached)
+        self._cache = dict((k, f) for k, f in zip(keys, feats) 
+                           if k is not None)
+        
+        feature_data = features.combine(feats, norm=self.normalize)
+        if 'is_valid' in spikes:
+            feature_data['is_valid'] = spikes['is_valid']
+        self._feature_data = feature_data
     
     def read_features(self):
         if self._feature_data is None:
@@ -344,6 +471,203 @@ class ClusterAnalyzer(base.Component):
         
     labels = property(read_labels)
 
+class ReplaySource(base.Component):
+    """Replay a recording in short buffers to simulate online
+    acquisition. If `realtime` is True, each buffer is returned only
+    when it would be available from the acquisition system (at
+    real-time speed)."""
+    waveform_src = base.RequiredFeature("SignalSource", 
+                                        base.HasAttributes("signal"))
+    
+    def __init__(self, buffer_size=10., realtime=True):
+        self.buffer_size = buffer_size
+        self.realtime = realtime
+        super(ReplaySource, self).__init__()
+    
+    def __iter__(self):
+        sp = self.waveform_src.signal
+        FS = sp['FS']
+        n_pts = sp['data'].shape[1]
+        n_buf = max(int(self.buffer_size/1000.*FS), 1)
+        t_start = time.time()
+        for start in xrange(0, n_pts, n_buf):
+            stop = min(start+n_buf, n_pts)
+            if self.realtime:
+                delay = t_start+stop/FS-time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            yield {'data': np.asarray(sp['data'][:, start:stop]), 
+                   'FS': FS, 'n_contacts': sp['n_contacts']}
+
+class OnlineSorter(base.Component):
+    """Sort spikes online by template matching.
+    
+    Templates (mean waveshapes) of the cells are calculated from the
+    spikes and labels of a previous run of the pipeline. Buffers of
+    raw data are filtered causally, spikes are detected and, as soon
+    as their waveshapes are complete, aligned and assigned to the
+    closest template. Filtered data are used only for detection and
+    alignment; waveshapes are cut from the raw data, so that they
+    match the templates calculated by SpikeExtractor. Processing time
+    of each buffer is stored in `latencies` (in seconds).
+    
+    The causal filter (`f_filter`) delays the signal by its group
+    delay, which is not compensated: spike times and the positions
+    of the cut waveshapes lag those of the batch (zero-phase)
+    pipeline by the delay (typically a few samples, e.g. about 0.1 ms
+    for a 500-3000 Hz band-pass filter)."""
+    spikes_src = base.RequiredFeature("SpikeSource", 
+                                      base.HasAttributes("spikes"))
+    labels_src = base.RequiredFeature("LabelSource", 
+                                      base.HasAttributes("labels"))
+    buffer_src = base.RequiredFeature("BufferSource")
+    
+    def __init__(self, thresh, 
+                 contact=0, 
+                 type='max', 
+                 sp_win=(-0.2, 0.8),
+                 f_filter=None,
+                 align=True,
+                 trash_label=0):
+        self.thresh = thresh
+        self.contact = contact
+        self.type = type
+        self.sp_win = sp_win
+        self.f_filter = f_filter
+        self.align = align
+        self.trash_label = trash_label
+        self.templates = None
+        super(OnlineSorter, self).__init__()
+        self.reset()
+    
+    def reset(self):
+        """Start sorting a new recording"""
+        if self.f_filter is None:
+            self._filter = None
+        else:
+            filter = sort.extract.Filter(*self.f_filter)
+            self._filter = sort.extract.CausalFilter(filter)
+        self._detector = sort.extract.OnlineDetector(self.thresh, 
+                                                     edge=self.type,
+                                                     contact=self.contact)
+        self._tail = None
+        self._raw_tail = None
+        self._tail_start = 0
+        self._pending = np.array([], dtype=np.int64)
+        self._spt = []
+        self._labels = []
+        self.latencies = []
+    
+    def _get_templates(self):
+        if self.templates is None:
+            self.templates = sort.cluster.calc_templates(
+                                    self.spikes_src.spikes,
+                                    self.labels_src.labels,
+                                    exclude=[self.trash_label])
+        return self.templates
+    
+    def _peak(self, sp_waves):
+        if self.type == 'max':
+            return sp_waves.argmax(1)
+        else:
+            return sp_waves.argmin(1)
+    
+    def process(self, spike_data):
+        """Sort spikes in the next buffer of the recording.
+        
+        Returns spike times (in miliseconds from the start of the
+        recording) and labels of the spikes whose waveshapes were
+        completed by this buffer.
+        """
+        t_start = time.time()
+        templates = self._get_templates()
+        FS = spike_data['FS']
+        win = (np.asarray(self.sp_win)/1000.*FS).astype(np.int32)
+        
+        raw = np.asarray(spike_data['data'], dtype=np.float64)
+        if self._filter is not None:
+            data = self._filter(raw, FS)
+        else:
+            data = raw
+        spt = self._detector({'data': data, 'FS': FS})['data']
+        
+        idx = np.round(spt/1000.*FS).astype(np.int64)
+        self._pending = np.concatenate((self._pending, idx))
+        if self._tail is None:
+            self._tail = data
+            self._raw_tail = raw
+        else:
+            self._tail = np.hstack((self._tail, data))
+            self._raw_tail = np.hstack((self._raw_tail, raw))
+        tail_end = self._tail_start+self._tail.shape[1]
+        
+        #spikes whose waveshapes (after alignment) are complete
+        extent = win[1]
+        if self.align:
+            extent += max(win[1]-1, 0)
+        ready = self._pending+extent <= tail_end
+        idx = self._pending[ready]
+        self._pending = self._pending[~ready]
+        
+        win_idx = np.arange(win[0], win[1])
+        idx = idx[idx+win[0] >= self._tail_start]
+        if self.align:
+            sp_waves = self._tail[self.contact, 
+                                  idx[:, np.newaxis]+win_idx-self._tail_start]
+            idx = idx+win[0]+self._peak(sp_waves)
+            idx = idx[idx+win[0] >= self._tail_start]
+        
+        sp_waves = self._raw_tail[:, 
+                                  idx[:, np.newaxis]+win_idx-self._tail_start]
+        sp_waves = sp_waves.transpose(2, 1, 0)
+        labels = sort.cluster.match_templates({'data': sp_waves}, templates)
+        spt = idx*1000./FS
+        self._spt.append(spt)
+        self._labels.append(labels)
+        
+        #keep only the samples that can be still needed
+        first = tail_end-1
+        if len(self._pending) > 0:
+            first = min(first, self._pending.min())
+        keep_from = first+win[0]
+        if self.align:
+            keep_from += min(win[0], 0)
+        if keep_from > self._tail_start:
+            self._tail = self._tail[:, keep_from-self._tail_start:]
+            self._raw_tail = self._raw_tail[:, keep_from-self._tail_start:]
+            self._tail_start = keep_from
+        
+        self.latencies.append(time.time()-t_start)
+        return {'data': spt, 'labels': labels}
+    
+    def run(self):
+        """Sort all buffers from the buffer source"""
+        self.reset()
+        for spike_data in self.buffer_src:
+            self.process(spike_data)
+        self.notify_observers()
+    
+    def latency_percentiles(self, q=(50, 90, 99)):
+        """Percentiles of buffer processing times (in miliseconds)"""
+        latencies = np.asarray(self.latencies)*1000.
+        return dict(zip(q, np.percentile(latencies, q)))
+    
+    def read_events(self):
+        if not self._spt:
+            return {'data': np.array([])}
+        return {'data': np.concatenate(self._spt)}
+    
+    def read_labels(self):
+        if not self._labels:
+            return np.array([], dtype=np.int16)
+        return np.concatenate(self._labels)
+    
+    def _update(self):
+        self.templates = None
+    
+    events = property(read_events)
+    labels = property(read_labels)
+
 class MplPlotComponent(base.Component):
     """Base class for plot components"""
     
@@ -207,3 +207,76 @@ def split_cells(spt_dict, idx, which='all'):
     spt_dicts = dict([(cl, {'data': spt[idx==cl]}) for cl in classes])
 
     return spt_dicts
+
+def calc_templates(spike_waves, labels, exclude=None):
+    """Calculate templates (mean waveshapes) of sorted cells
+    
+    Parameters
+    ----------
+    spike_waves : dict
+        spike waveforms structure (see :ref:`spike_wave`)
+    labels : array
+        cluster label of each spike
+    exclude : list, optional
+        labels that are not used as templates (for example, the trash
+        cluster)
+     
+    Returns
+    -------
+    templates : dict
+        spike waveforms structure with one waveshape per cell; cell
+        labels are stored in `labels` field
+    """
+    
+    labels = np.asarray(labels)
+    mask = spike_waves.get('is_valid')
+    if mask is None:
+        mask = np.ones(len(labels), dtype=np.bool)
+    
+    cells = np.unique(labels[mask])
+    if exclude is not None:
+        cells = np.setdiff1d(cells, exclude)
+    
+    sp_data = spike_waves['data']
+    n_pts, _, n_contacts = sp_data.shape
+    templates = np.empty((n_pts, len(cells), n_contacts))
+    for i, cell in enumerate(cells):
+        templates[:, i, :] = sp_data[:, mask & (labels==cell), :].mean(1)
+    
+    return {'data': templates, 'time': spike_waves['time'],
+            'FS': spike_waves.get('FS'), 'labels': cells}
+
+def match_templates(spike_waves, templates):
+    """Assign spikes to the closest template (in Euclidean distance)
+    
+    Parameters
+    ----------
+    spike_waves : dict
+        spike waveforms structure (see :ref:`spike_wave`)
+    templates : dict
+        templates as returned by :py:func:`calc_templates`
+     
+    Returns
+    -------
+    labels : array
+        label of the closest template for each spike
+    """
+    
+    sp_data = spike_waves['data']
+    tmpl_data = templates['data']
+    if len(templates['labels']) == 0:
+        raise ValueError("no templates to match spikes against")
+    if sp_data.shape[0] != tmpl_data.shape[0] or \
+       sp_data.shape[2] != tmpl_data.shape[2]:
+        raise TypeError("spike waveshapes and templates must have the "
+                        "same number of samples and contacts")
+    
+    n_pts, n_spikes, n_contacts = sp_data.shape
+    x = sp_data.swapaxes(0, 1).reshape(n_spikes, n_pts*n_contacts)
+    t = tmpl_data.swapaxes(0, 1).reshape(tmpl_data.shape[1], 
+                                         n_pts*n_contacts)
+    
+    #squared distance without the (constant) norm of the spike
+    dist = (t*t).sum(1)[np.newaxis, :] - 2*np.dot(x, t.T)
+    
+    return templates['labels'][dist.argmin(1)]
@@ -8,6 +8,12 @@ import warnings
 def deprecation(message):
     warnings.warn(message, DeprecationWarning, stacklevel=2)
 
+def _iter_blocks(sp_data, blocksize=10000):
+    """Iterate over blocks of spike waveshapes (so that waveshapes
+    stored on disk are never loaded at once)"""
+    for start in range(0, sp_data.shape[1], blocksize):
+        yield np.asarray(sp_data[:, start:start+blocksize])
+
 def snr_spike(spike_waves, scale=5.):
     """Estimate signal-to-noise ratio (SNR) as a ratio of
     peak-to-peak amplitude of an average spike to the std. deviation
@@ -24,13 +30,17 @@ def snr_spike(spike_waves, scale=5.):
     """
     
     sp_data = spike_waves['data']
-    avg_spike = sp_data.mean(1)
+    n_spikes = sp_data.shape[1]
+    avg_spike = sum(b.sum(1, dtype=np.float64) 
+                    for b in _iter_blocks(sp_data))/n_spikes
 
     peak_to_peak = avg_spike.max()-avg_spike.min()
 
-    residuals = sp_data-avg_spike[:, np.newaxis]
+    #residuals have zero mean, so their variance is the mean square
+    sq_residuals = sum(((b-avg_spike[:, np.newaxis])**2).sum()
+                       for b in _iter_blocks(sp_data))
 
-    noise_std = np.sqrt(residuals.var())
+    noise_std = np.sqrt(sq_residuals/sp_data.size)
 
     snr = peak_to_peak/(noise_std*scale)
 
@@ -54,8 +64,8 @@ def snr_clust(spike_waves, noise_waves):
     """
 
     def _calc_p2p(data):
-        p2p = data.max(0)-data.min(0)
-        return p2p.mean()
+        p2p = sum((b.max(0)-b.min(0)).sum() for b in _iter_blocks(data))
+        return p2p*1./(data.shape[1]*data.shape[2])
 
     sp_data = spike_waves['data']
     avg_p2p_spk = _calc_p2p(sp_data)
@@ -143,7 +153,8 @@ def calc_noise_threshold(spike_waves, sign=1, frac_spikes=0.02, frac_max=0.5):
 
     gain = np.sign(sign)
 
-    peak_amp = np.max(gain*spike_waves['data'],0)     
+    peak_amp = np.concatenate([np.max(gain*b, 0) 
+                               for b in _iter_blocks(spike_waves['data'])])
     frac_spikes = 0.02
     frac_max = 0.5
     peak_amp.sort()
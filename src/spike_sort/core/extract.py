@@ -7,33 +7,103 @@ import tables
 import tempfile 
 import os
 from warnings import warn
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+
+def _sosfiltfilt(sos, x, dtype=None):
+    """Zero-phase filtering with cascaded second-order sections"""
+    if dtype is not None:
+        sos = sos.astype(dtype)
+        x = np.asarray(x, dtype=dtype)
+    y = signal.sosfiltfilt(sos, x)
+    if dtype is not None:
+        y = y.astype(dtype, copy=False)
+    return y
 
 class ZeroPhaseFilter:
-    """IIR Filter with zero phase delay"""
+    """IIR Filter with zero phase delay
+    
+    If `output` is 'sos' the filter is applied as a cascade of
+    second-order sections, which is more robust for high filter orders;
+    `dtype` sets the data type of the filtered signal (float32 halves
+    the memory).
+    """
 
-    def __init__(self, ftype, fband, tw=200., stop=20):
+    def __init__(self, ftype, fband, tw=200., stop=20, output='ba',
+                 dtype=None):
         self.gstop=stop
         self.gpass=1
         self.fband = fband
         self.tw = tw
         self.ftype = ftype
+        self.output = output
+        self.dtype = dtype
         self._coefs_cache = {}
+        self._sos_cache = {}
+
+    def _design(self, FS, output):
+        wp = np.array(self.fband)
+        ws = wp + np.array([-self.tw, self.tw])
+        wp, ws = wp*2./FS, ws*2./FS
+        return signal.iirdesign(wp=wp, ws=ws, gstop=self.gstop, 
+                                gpass=self.gpass, ftype=self.ftype,
+                                output=output)
 
     def _design_filter(self, FS):
         
         if not FS in self._coefs_cache:
-            wp = np.array(self.fband)
-            ws = wp + np.array([-self.tw, self.tw])
-            wp, ws = wp*2./FS, ws*2./FS
-            b,a = signal.iirdesign(wp=wp, ws=ws, gstop=self.gstop, gpass=self.gpass, ftype=self.ftype)
+            b,a = self._design(FS, 'ba')
             self._coefs_cache[FS]=(b,a)
         else:
             b,a = self._coefs_cache[FS]
         return b, a  
 
+    def _design_sos(self, FS):
+        if not FS in self._sos_cache:
+            self._sos_cache[FS] = self._design(FS, 'sos')
+        return self._sos_cache[FS]
+
     def __call__(self, x, FS):
+        if self.output == 'sos':
+            return _sosfiltfilt(self._design_sos(FS), x, self.dtype)
         b, a = self._design_filter(FS)
-        return signal.filtfilt(b,a, x)
+        y = signal.filtfilt(b,a, x)
+        if self.dtype is not None:
+            y = y.astype(self.dtype)
+        return y
+
+def _oa_convolve(x, b):
+    """First len(x) samples of the convolution of `x` with `b` computed
+    by FFT in overlapping blocks (overlap-add method)"""
+    n_taps = len(b)
+    nfft = max(2**int(np.ceil(np.log2(8*n_taps))), 4096)
+    step = nfft-n_taps+1
+    B = np.fft.rfft(b, nfft)
+    n_pts = len(x)
+    y = np.zeros(n_pts+nfft)
+    for start in range(0, n_pts, step):
+        block = np.fft.irfft(np.fft.rfft(x[start:start+step], nfft)*B, nfft)
+        y[start:start+nfft] += block
+    return y[:n_pts]
+
+def _fir_lfilter(b, x):
+    """FIR filtering with initial conditions as in filtfilt (constant
+    signal equal to the first sample before the start)"""
+    n_taps = len(b)
+    x = np.concatenate((np.repeat(x[0], n_taps-1), x))
+    return _oa_convolve(x, b)[n_taps-1:]
+
+def _fir_filtfilt(b, x):
+    """Equivalent of signal.filtfilt(b, [1], x) using FFT convolution"""
+    padlen = 3*len(b)
+    if len(x) <= padlen:
+        return signal.filtfilt(b, [1], x)
+    x = np.asarray(x, dtype=np.float64)
+    ext = np.concatenate((2*x[0]-x[padlen:0:-1], x,
+                          2*x[-1]-x[-2:-padlen-2:-1]))
+    y = _fir_lfilter(b, ext)
+    y = _fir_lfilter(b, y[::-1])[::-1]
+    return y[padlen:-padlen]
 
 class FilterFir:
     """FIR filter with zero phase delay
@@ -49,13 +119,17 @@ class FilterFir:
     order : int
             filter order
       
+    fft_threshold : int
+            filters of this order or higher are applied by FFT
+            convolution in overlapping blocks (faster for long filters)
     
     """
-    def __init__(self, f_pass, f_stop, order):
+    def __init__(self, f_pass, f_stop, order, fft_threshold=128):
         self._coefs_cache = {}
         self.fp = f_pass
         self.fs = f_stop
         self.order = order
+        self.fft_threshold = fft_threshold
         
     def _design_filter(self, FS):
         if not FS in self._coefs_cache:
@@ -69,31 +143,203 @@ class FilterFir:
     
     def __call__(self, x, FS):
         b, a = self._design_filter(FS)
+        if self.order >= self.fft_threshold:
+            if np.ndim(x) > 1:
+                return np.array([self(row, FS) for row in x])
+            return _fir_filtfilt(b, x)
         return signal.filtfilt(b, a, x)
 
 class Filter:
-    def __init__(self, fpass, fstop, gpass=1, gstop=10, ftype='butter'):
+    """IIR filter with zero phase delay
+    
+    If `output` is 'sos' the filter is applied as a cascade of
+    second-order sections, which is more robust for high filter orders;
+    `dtype` sets the data type of the filtered signal (float32 halves
+    the memory).
+    """
+    def __init__(self, fpass, fstop, gpass=1, gstop=10, ftype='butter',
+                 output='ba', dtype=None):
         self.ftype = ftype
         self.fp = np.asarray(fpass)
         self.fs = np.asarray(fstop)
         self._coefs_cache = {}
+        self._sos_cache = {}
         self.gstop = gstop
         self.gpass = gpass
+        self.output = output
+        self.dtype = dtype
  
+    def _design(self, FS, output):
+        wp, ws = self.fp*2/FS, self.fs*2/FS
+        return signal.iirdesign(wp=wp, ws=ws, gstop=self.gstop, 
+                                gpass=self.gpass, ftype=self.ftype,
+                                output=output)
+
     def _design_filter(self, FS):
         if not FS in self._coefs_cache:
-            wp, ws = self.fp*2/FS, self.fs*2/FS
-            b,a = signal.iirdesign(wp=wp, ws=ws, gstop=self.gstop, gpass=self.gpass, ftype=self.ftype)
+            b,a = self._design(FS, 'ba')
             self._coefs_cache[FS]=(b,a)
         else:
             b,a = self._coefs_cache[FS]
         return b, a  
     
+    def _design_sos(self, FS):
+        if not FS in self._sos_cache:
+            self._sos_cache[FS] = self._design(FS, 'sos')
+        return self._sos_cache[FS]
+    
     def __call__(self, x, FS):
+        if self.output == 'sos':
+            return _sosfiltfilt(self._design_sos(FS), x, self.dtype)
         b, a = self._design_filter(FS)
-        return signal.filtfilt(b,a, x)
+        y = signal.filtfilt(b,a, x)
+        if self.dtype is not None:
+            y = y.astype(self.dtype)
+        return y
+    
+class CausalFilter:
+    """Causal version of a filter for online (real-time) processing.
     
-def filter_proxy(spikes, filter_obj, chunksize=1E6):
+    The filter state is kept between calls, so that filtering
+    consecutive buffers of a recording gives the same result as
+    filtering their concatenation. The filter is initialised at steady
+    state for the first sample of the first buffer. Multidimensional
+    buffers are filtered along the last axis.
+    
+    Parameters
+    ----------
+    filter : object
+        filter design (:class:`Filter`, :class:`ZeroPhaseFilter` or
+        :class:`FilterFir`)
+    """
+    
+    def __init__(self, filter):
+        self.filter = filter
+        self.reset()
+    
+    def reset(self):
+        """Forget the filter state (start a new recording)"""
+        self._zi = None
+        self._FS = None
+    
+    def __call__(self, x, FS):
+        x = np.asarray(x, dtype=np.float64)
+        if FS != self._FS:
+            self.reset()
+            self._FS = FS
+        
+        if getattr(self.filter, 'output', 'ba') == 'sos':
+            sos = self.filter._design_sos(FS)
+            if self._zi is None:
+                zi = signal.sosfilt_zi(sos)
+                zi = zi.reshape((len(sos),)+(1,)*(x.ndim-1)+(2,))
+                self._zi = zi*x[..., 0][np.newaxis, ..., np.newaxis]
+            y, self._zi = signal.sosfilt(sos, x, zi=self._zi)
+        else:
+            b, a = self.filter._design_filter(FS)
+            if self._zi is None:
+                self._zi = signal.lfilter_zi(b, a)*x[..., :1]
+            y, self._zi = signal.lfilter(b, a, x, zi=self._zi)
+        return y
+
+class FilteredArray(object):
+    """Filtered recording computed on demand.
+    
+    The object can be sliced like a (n_contacts, n_pts) array. Only
+    the blocks of `blocksize` samples overlapping with the requested 
+    range are filtered (each extended by `overlap` samples on both
+    sides to avoid transients at block boundaries). The most recently
+    used `cache_size` blocks are kept in memory.
+    
+    Parameters
+    ----------
+    data : array
+        (n_contacts, n_pts) raw recording (numpy or PyTables array)
+    filter_obj : object
+        Filter to filter the data
+    FS : float
+        sampling frequency
+    overlap : int or 'auto', optional
+        number of samples by which the blocks are extended; if 'auto'
+        it is estimated from the filter coefficients
+    blocksize : int, optional
+        number of samples filtered at once
+    cache_size : int, optional
+        maximum number of blocks kept in memory
+    """
+    
+    def __init__(self, data, filter_obj, FS, overlap='auto', blocksize=1E5,
+                 cache_size=64):
+        self.data = data
+        self.filter_obj = filter_obj
+        self.FS = FS
+        if overlap == 'auto':
+            overlap = _filter_margin(filter_obj, FS)
+        self.overlap = int(overlap)
+        self.blocksize = int(blocksize)
+        self.cache_size = cache_size
+        self.shape = data.shape
+        self.chunkshape = (1, self.blocksize)
+        self._cache = OrderedDict()
+        
+    def __len__(self):
+        return self.shape[0]
+    
+    def __array__(self, dtype=None):
+        return np.asarray(self[:, :], dtype)
+    
+    def _get_block(self, contact, block):
+        key = (contact, block)
+        try:
+            x = self._cache.pop(key)
+        except KeyError:
+            start = block*self.blocksize
+            stop = min(start+self.blocksize, self.shape[1])
+            left = max(start-self.overlap, 0)
+            x = self.data[contact, left:stop+self.overlap]
+            x = self.filter_obj(x, self.FS)[start-left:stop-left]
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[key] = x
+        return x
+    
+    def _read(self, contact, start, stop):
+        if stop <= start:
+            return np.empty(0)
+        first, last = start//self.blocksize, (stop-1)//self.blocksize
+        x = np.concatenate([self._get_block(contact, b) 
+                            for b in range(first, last+1)])
+        offset = first*self.blocksize
+        return x[start-offset:stop-offset]
+    
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        contacts, time = key
+        n_pts = self.shape[1]
+        
+        contacts = np.arange(self.shape[0])[contacts]
+        if isinstance(time, slice):
+            start, stop, step = time.indices(n_pts)
+        else:
+            start = time+n_pts if time < 0 else time
+            if not 0 <= start < n_pts:
+                raise IndexError("index out of bounds")
+            stop, step = start+1, 1
+        if step < 0:
+            raise IndexError("negative steps are not supported")
+        
+        rows = [self._read(c, start, stop)[::step] 
+                for c in np.atleast_1d(contacts)]
+        x = np.array(rows)
+        if np.ndim(contacts) == 0:
+            x = x[0]
+        if not isinstance(time, slice):
+            x = x[..., 0]
+        return x
+
+def filter_proxy(spikes, filter_obj, chunksize=1E6, n_jobs=1, overlap=0,
+                 lazy=False):
     """Proxy object to read filtered data
     
     Parameters
@@ -104,6 +350,23 @@ def filter_proxy(spikes, filter_obj, chunksize=1E6):
         Filter to filter the data
     chunksize : int
         size of segments in which data is filtered
+    n_jobs : int, optional
+        number of threads filtering contacts and segments concurrently
+        (SciPy releases the GIL during filtering); the data is read and
+        written only by the calling thread, so the result does not 
+        depend on `n_jobs`
+    overlap : int or 'auto', optional
+        number of samples by which segments are extended on both sides
+        before filtering (the extension is discarded afterwards); it
+        should be longer than the impulse response of the filter to
+        avoid transients at segment boundaries. If 'auto' it is
+        estimated from the filter coefficients. Defaults to
+        non-overlapping segments.
+    lazy : bool, optional
+        if True, do not filter the data in advance, but return a
+        :class:`FilteredArray` which filters only the requested parts
+        of the recording (`chunksize`, `n_jobs` and `overlap` are then
+        ignored)
         
     Returns
     -------
@@ -116,6 +379,10 @@ def filter_proxy(spikes, filter_obj, chunksize=1E6):
     if filter_obj is None:
         return spikes
     
+    if lazy:
+        sp_dict['data'] = FilteredArray(data, filter_obj, sp_dict['FS'])
+        return sp_dict
+    
     tmp_file = tempfile.NamedTemporaryFile(mode='w')
     filename = tmp_file.name
     atom = tables.Atom.from_dtype(np.dtype('float64'))
@@ -123,16 +390,196 @@ def filter_proxy(spikes, filter_obj, chunksize=1E6):
     h5f = tables.openFile(filename,'w')
     carray = h5f.createCArray('/', "test", atom, shape)
     
+    FS = sp_dict['FS']
+    n_jobs = max(int(n_jobs), 1)
+    if overlap == 'auto':
+        overlap = _filter_margin(filter_obj, FS)
+    overlap = int(overlap)
     chunksize = int(chunksize)
     n_chunks = int(np.ceil(shape[1]*1./chunksize))
-    for i in range(shape[0]):
-        for j in range(n_chunks):
-            stop = int(np.min(((j+1)*chunksize, shape[1])))
-            carray[i,j*chunksize:stop] = filter_obj(data[i,j*chunksize:stop], sp_dict['FS'])
+    segments = [(i, j*chunksize, int(np.min(((j+1)*chunksize, shape[1]))))
+                for i in range(shape[0]) for j in range(n_chunks)]
+    
+    def _filter_segment(segment):
+        x, start, stop = segment
+        left = max(start-overlap, 0)
+        return filter_obj(x, FS)[start-left:stop-left]
+    
+    if n_jobs > 1:
+        pool = ThreadPool(n_jobs)
+        _map = pool.map
+    else:
+        _map = map
+    
+    #process as many segments at once as there are workers
+    try:
+        for k in range(0, len(segments), n_jobs):
+            batch = segments[k:k+n_jobs]
+            chunks = [(data[i, max(start-overlap, 0):stop+overlap], start, 
+                       stop) for i, start, stop in batch]
+            filtered = _map(_filter_segment, chunks)
+            for (i, start, stop), x in zip(batch, filtered):
+                carray[i, start:stop] = x
+    finally:
+        if n_jobs > 1:
+            pool.close()
     sp_dict['data'] = carray
     return sp_dict
     
 
+def _inv_sqrtm(cov, eps=1E-6):
+    """Inverse matrix square root of a covariance matrix (eigenvalues
+    smaller than `eps` times the largest are clipped)"""
+    w, v = np.linalg.eigh(cov)
+    if w.max() <= 0:
+        raise ValueError("noise covariance is zero")
+    w = np.maximum(w, eps*w.max())
+    return np.dot(v/np.sqrt(w), v.T)
+
+class Whitening:
+    """Noise whitening transform.
+    
+    The noise covariance between contacts (spatial) and, optionally,
+    between samples of the spike window (temporal) is estimated from
+    spike-free segments of the recording. The transform can be then
+    applied to the recording (:meth:`whiten_signal`, spatial only) or
+    to the spike waveshapes (:meth:`whiten_spikes`). Symmetric (ZCA)
+    whitening matrices are used, so each whitened contact is still
+    dominated by the original one.
+    
+    Parameters
+    ----------
+    temporal : bool
+        if True, estimate also the temporal covariance of noise within
+        the spike window and use it for whitening spike waveshapes
+    eps : float
+        regularisation of the covariance eigenvalues (relative to the
+        largest one)
+    """
+    
+    def __init__(self, temporal=False, eps=1E-6):
+        self.temporal = temporal
+        self.eps = eps
+        self.W = None
+        self.W_temporal = None
+        self.n_pts = None
+    
+    def fit(self, spike_data, spt_dict=None, sp_win=(-0.2, 0.8), filter=None,
+            n_blocks=100, block_len=100.):
+        """Estimate the noise covariance.
+        
+        Parameters
+        ----------
+        spike_data : dict
+            extracellular data (see :ref:`raw_recording`)
+        spt_dict : dict, optional
+            spike times; samples within `sp_win` around the spikes are
+            excluded from the estimate
+        sp_win : list of float
+            spike window (also the length of the noise segments used
+            for the temporal covariance)
+        filter : object, optional
+            filter applied to the data before estimation
+        n_blocks : int
+            number of blocks sampled from the recording
+        block_len : float
+            length of each block in miliseconds
+        
+        Returns
+        -------
+        self : Whitening
+        """
+        data = spike_data['data']
+        FS = spike_data['FS']
+        n_pts = data.shape[1]
+        win = (np.asarray(sp_win)/1000.*FS).astype(np.int32)
+        self.n_pts = win[1]-win[0]
+        
+        if spt_dict is None:
+            sp_idx = np.array([], dtype=np.int64)
+        else:
+            sp_idx = np.sort((spt_dict['data']/1000.*FS).astype(np.int64))
+        
+        margin = 0 if filter is None else _filter_margin(filter, FS)
+        blocks = _sample_blocks(0, n_pts, n_blocks, 
+                                max(int(block_len/1000.*FS), self.n_pts))
+        samples, segments = [], []
+        for start, stop in blocks:
+            left = max(start-margin, 0)
+            x = np.asarray(data[:, left:stop+margin], dtype=np.float64)
+            if filter is not None:
+                x = filter(x, FS)
+            x = x[:, start-left:stop-left]
+            
+            #mark samples covered by spike windows
+            lo, hi = np.searchsorted(sp_idx, [start-win[1], stop-win[0]])
+            i = sp_idx[lo:hi]-start
+            cover = np.zeros(stop-start+1, dtype=np.int64)
+            np.add.at(cover, np.clip(i+win[0], 0, stop-start), 1)
+            np.add.at(cover, np.clip(i+win[1], 0, stop-start), -1)
+            is_noise = np.cumsum(cover)[:-1] == 0
+            samples.append(x[:, is_noise])
+            
+            if self.temporal:
+                for p in range(0, stop-start-self.n_pts+1, self.n_pts):
+                    if is_noise[p:p+self.n_pts].all():
+                        segments.append(x[:, p:p+self.n_pts].T.ravel())
+        
+        self.W = _inv_sqrtm(np.atleast_2d(np.cov(np.hstack(samples))),
+                            self.eps)
+        if self.temporal:
+            if len(segments) < 2:
+                raise ValueError("not enough spike-free segments to "
+                                 "estimate the temporal covariance")
+            cov = np.cov(np.array(segments), rowvar=0)
+            self.W_temporal = _inv_sqrtm(cov, self.eps)
+        return self
+    
+    def whiten_signal(self, spike_data, chunksize=1E6):
+        """Whiten the recording between contacts (chunk by chunk).
+        
+        The whitened recording is written to a temporary file, as in
+        :func:`filter_proxy`.
+        """
+        data = spike_data['data']
+        sp_dict = spike_data.copy()
+        
+        tmp_file = tempfile.NamedTemporaryFile(mode='w')
+        atom = tables.Atom.from_dtype(np.dtype('float64'))
+        h5f = tables.openFile(tmp_file.name, 'w')
+        carray = h5f.createCArray('/', "test", atom, data.shape)
+        
+        chunksize = int(chunksize)
+        for start in range(0, data.shape[1], chunksize):
+            stop = min(start+chunksize, data.shape[1])
+            x = np.asarray(data[:, start:stop], dtype=np.float64)
+            carray[:, start:stop] = np.dot(self.W, x)
+        sp_dict['data'] = carray
+        return sp_dict
+    
+    def whiten_spikes(self, spike_waves):
+        """Whiten spike waveshapes (see :ref:`spike_wave`).
+        
+        The temporal covariance is used if it was estimated (the
+        waveshapes must have the same length as the spike window
+        passed to :meth:`fit`), otherwise only the spatial one.
+        """
+        sp_data = spike_waves['data']
+        n_pts, n_spikes, n_contacts = sp_data.shape
+        if self.W_temporal is not None:
+            if n_pts != self.n_pts:
+                raise ValueError("spike waveshapes must have %d samples" %
+                                 self.n_pts)
+            x = sp_data.swapaxes(0, 1).reshape(n_spikes, n_pts*n_contacts)
+            x = np.dot(x, self.W_temporal)
+            x = x.reshape(n_spikes, n_pts, n_contacts).swapaxes(0, 1)
+        else:
+            x = np.dot(sp_data, self.W)
+        
+        new_waves = spike_waves.copy()
+        new_waves['data'] = x.astype(sp_data.dtype)
+        return new_waves
+
 def split_cells(spikes, idx, which='all'):
     """Return the spike features splitted into separate cells
     """
@@ -151,14 +598,22 @@ def split_cells(spikes, idx, which='all'):
 
 def remove_spikes(spt_dict, remove_dict, tolerance):
     """Remove spikes with given spike times from the spike time
-    structure """
+    structure 
+    
+    A spike is removed if it lies within the interval
+    [t+tolerance[0], t+tolerance[1]] around any of the spike times t
+    from `remove_dict`."""
     spt_data = spt_dict['data']
-    spt_remove = remove_dict['data']
+    spt_remove = np.sort(remove_dict['data'])
 
     min, max = tolerance
 
-    for t in spt_remove:
-        spt_data = spt_data[(spt_data>(t+max)) | (spt_data<(t+min))]
+    if len(spt_remove) > 0:
+        #interval bounds are sorted, so the last interval starting
+        #before the spike has the largest end among such intervals
+        n_before = np.searchsorted(spt_remove+min, spt_data, 'right')
+        last_end = (spt_remove+max)[np.maximum(n_before-1, 0)]
+        spt_data = spt_data[(n_before==0) | (last_end<spt_data)]
 
     spt_ret = spt_dict.copy()
 
@@ -166,8 +621,246 @@ def remove_spikes(spt_dict, remove_dict, tolerance):
 
     return spt_ret
 
+def _impulse_length(n_fir, poles, tol=1E-6):
+    """Estimate number of samples after which the impulse response of
+    a filter with `n_fir` numerator coefficients and given poles decays
+    below `tol`"""
+    if len(poles) == 0:
+        return n_fir
+    r = np.abs(poles).max()
+    if r >= 1:
+        raise ValueError("filter is unstable")
+    return n_fir + int(np.ceil(np.log(tol)/np.log(r)))
+
+def _filter_margin(filter, FS):
+    """Number of samples to pad chunks with, so that filter transients
+    decay before the chunk proper starts"""
+    try:
+        if getattr(filter, 'output', 'ba') == 'sos':
+            #find poles of each section separately (better conditioned)
+            sos = filter._design_sos(FS)
+            poles = np.concatenate([np.roots(a) for a in sos[:, 3:]])
+            return _impulse_length(2*len(sos)+1, poles)
+        b, a = filter._design_filter(FS)
+    except AttributeError:
+        #unknown filter object: assume 10 ms is enough
+        return int(0.01*FS)
+    return _impulse_length(len(b), np.roots(a))
+
+def _iter_crossings(sp_data, thresh, edge, FS, filter=None,
+                    chunksize=1E6, margin=None, window=None, peak_len=0):
+    """Find threshold crossings of a one-dimensional signal by chunks.
+
+    Yields arrays of sample indices of crossings found in consecutive
+    chunks, such that concatenating them gives the same result as
+    testing the whole signal at once. Each chunk is padded by a single
+    sample on the right (for the crossing test) and, if `filter` is
+    given, by `margin` samples on both sides to let the filter
+    transients decay. If `window` is given, `thresh` is a sequence of
+    thresholds for consecutive windows of `window` samples (a single
+    threshold is used for all windows).
+
+    If chunks of `sp_data` are two-dimensional (contacts x samples),
+    crossings on any of the contacts are returned together with the
+    index of the contact with the largest peak within `peak_len`
+    samples after the crossing.
+    """
+
+    if edge == "rising" or edge == "max":
+        crossing = lambda x, t: (x[..., :-1]<t) & (x[..., 1:]>t)
+        peak = lambda x: x.max(-1).argmax(0)
+    elif edge == "falling" or edge == "min":
+        crossing = lambda x, t: (x[..., :-1]>t) & (x[..., 1:]<t)
+        peak = lambda x: x.min(-1).argmin(0)
+    else:
+        raise TypeError("Edge must be 'rising' or 'falling'")
+    
+    if window is not None:
+        thresh = np.atleast_1d(thresh)
+        window = int(window)
+
+    if filter is None:
+        margin = 0
+    elif margin is None:
+        margin = _filter_margin(filter, FS)
+
+    n_pts = len(sp_data)
+    chunksize = int(chunksize)
+    for start in range(0, n_pts, chunksize):
+        stop = min(start+chunksize, n_pts)
+        left = max(start-margin, 0)
+        right = min(stop+1+peak_len+margin, n_pts)
+        chunk = sp_data[left:right]
+        if filter is not None:
+            chunk = filter(chunk, FS)
+        chunk = chunk[..., start-left:stop+1+peak_len-left]
+        test = chunk[..., :stop+1-start]
+        if window is None:
+            t = thresh
+        else:
+            i_win = np.arange(start, start+test.shape[-1]-1)//window
+            t = thresh[np.minimum(i_win, len(thresh)-1)]
+        if chunk.ndim == 1:
+            i, = np.where(crossing(test, t))
+            yield i+start
+        else:
+            i, = np.where(crossing(test, t).any(0))
+            n_chunk = chunk.shape[1]
+            idx = np.minimum(i[:, np.newaxis]+1+np.arange(max(peak_len, 1)),
+                             n_chunk-1)
+            yield i+start, peak(chunk[:, idx])
+
+def _estimate_threshold(sp_data, thresh, FS, filter=None):
+    """Estimate detection threshold from the first 10 seconds of the
+    signal"""
+
+    if thresh=='auto':
+        thresh_frac = 8
+    else:
+        thresh_frac = float(thresh)
+    
+    n_est = int(10*FS)
+    if filter is not None:
+        sp_data = filter(sp_data[:n_est+_filter_margin(filter, FS)], FS)
+    return thresh_frac*np.sqrt(float(np.var(sp_data[:n_est])))
+
+def _sample_blocks(start, stop, n_blocks, block_len, sampling='strided',
+                   seed=None):
+    """Choose `n_blocks` blocks of `block_len` samples between `start`
+    and `stop`; returns a list of (start, stop) tuples"""
+    
+    n_pts = stop-start
+    if n_pts <= n_blocks*block_len:
+        return [(start, stop)]
+    if sampling == 'strided':
+        starts = start+(np.arange(n_blocks)*(n_pts-block_len) //
+                        max(n_blocks-1, 1))
+    elif sampling == 'random':
+        rng = np.random.RandomState(seed)
+        starts = np.sort(rng.randint(start, stop-block_len+1, n_blocks))
+    else:
+        raise ValueError("sampling must be 'strided' or 'random'")
+    return [(b, b+block_len) for b in starts]
+
+def _block_threshold(sp_data, thresh_frac, FS, blocks, filter=None,
+                     method='mad'):
+    """Estimate detection threshold from samples in the given blocks;
+    blocks are read (and filtered) one at a time"""
+    
+    margin = 0 if filter is None else _filter_margin(filter, FS)
+    n_pts = len(sp_data)
+    samples = []
+    for start, stop in blocks:
+        left = max(start-margin, 0)
+        right = min(stop+margin, n_pts)
+        block = sp_data[left:right]
+        if filter is not None:
+            block = filter(block, FS)
+        samples.append(np.asarray(block[start-left:stop-left], 
+                                  dtype=np.float64))
+    x = np.concatenate(samples)
+    
+    if method == 'mad':
+        sigma = np.median(np.abs(x-np.median(x)))/0.6745
+    elif method == 'std':
+        sigma = np.std(x)
+    else:
+        raise ValueError("method must be 'mad' or 'std'")
+    return thresh_frac*sigma
+
+def estimate_threshold(spike_data, thresh='auto', contact=0, filter=None,
+                       method='mad', window=None, n_blocks=100, 
+                       block_len=100., sampling='strided', seed=None):
+    """Estimate spike detection threshold from the noise level.
+    
+    The noise standard deviation is estimated from `n_blocks` blocks
+    spread over the whole recording (or over each `window` of the
+    recording), so that slow changes of the noise are represented
+    while only a small part of the data is read. The blocks are read
+    and filtered one at a time, so disk-based recordings are never
+    loaded in full.
+    
+    Parameters
+    ----------
+    spike_data : dict
+        extracellular waveforms (see :ref:`raw_recording`)
+    thresh : float or 'auto'
+        threshold as a multiple of the noise standard deviation; 'auto'
+        is 5 for `method` 'mad' and 8 for 'std'
+    contact : int, optional
+        index of tetrode contact
+    filter : object, optional
+        filter applied to each block before estimation
+    method : {'mad', 'std'}
+        noise estimator: median absolute deviation (robust to spikes)
+        scaled to the standard deviation of gaussian noise, or the
+        standard deviation
+    window : float, optional
+        if given, a separate threshold is estimated for each
+        consecutive window of `window` miliseconds (adaptive threshold)
+    n_blocks : int
+        number of blocks to sample (per window)
+    block_len : float
+        length of each block in miliseconds
+    sampling : {'strided', 'random'}
+        evenly spaced or randomly placed blocks
+    seed : int, optional
+        seed of the random number generator for `random` sampling
+    
+    Returns
+    -------
+    thresh : float or array
+        detection threshold (one per window, if `window` is given)
+    """
+    
+    if thresh == 'auto':
+        thresh_frac = 5. if method == 'mad' else 8.
+    else:
+        thresh_frac = float(thresh)
+    
+    FS = spike_data['FS']
+    sp_data = _ContactView(spike_data['data'], contact)
+    n_pts = len(sp_data)
+    block_len = max(int(block_len/1000.*FS), 1)
+    
+    if window is None:
+        windows = [(0, n_pts)]
+    else:
+        window = max(int(window/1000.*FS), 1)
+        windows = [(w, min(w+window, n_pts)) for w in range(0, n_pts, window)]
+    
+    thresh = [_block_threshold(sp_data, thresh_frac, FS,
+                               _sample_blocks(start, stop, n_blocks,
+                                              block_len, sampling, seed),
+                               filter, method)
+              for start, stop in windows]
+    
+    if window is None:
+        return thresh[0]
+    return np.array(thresh)
+
+class _ContactView(object):
+    """One-dimensional view of a single contact (or two-dimensional
+    view of a list of contacts) of a (possibly disk-based) recording;
+    data is read only when sliced"""
+
+    def __init__(self, data, contact):
+        self.data = data
+        if np.ndim(contact) == 1 and len(contact) > 0 and \
+           (np.diff(contact) == 1).all():
+            #consecutive contacts are sliced to avoid a copy
+            contact = slice(contact[0], contact[-1]+1)
+        self.contact = contact
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def __getitem__(self, s):
+        return self.data[self.contact, s]
+
 def detect_spikes(spike_data, thresh='auto', edge="rising",
-                  contact=0, filter=None):
+                  contact=0, filter=None, chunksize=None,
+                  thresh_method='std', thresh_window=None):
     r"""Detects spikes in extracellular data using amplitude thresholding.
 
     Parameters
@@ -184,6 +877,20 @@ def detect_spikes(spike_data, thresh='auto', edge="rising",
         first contact
     filter : object, optional
         filter used for spike detection; defaults to no filtering
+    chunksize : int, optional
+        if given, the recording is read (and filtered) in overlapping
+        segments of `chunksize` samples, so that the memory use does
+        not depend on the recording length; defaults to processing the
+        whole recording at once
+    thresh_method : {'std', 'mad'}
+        how the threshold is estimated: 'std' uses the standard
+        deviation of the first 10 seconds, 'mad' the median absolute
+        deviation of blocks spread over the whole recording (see
+        :func:`estimate_threshold`)
+    thresh_window : float, optional
+        if given, the threshold is estimated (or given as a sequence
+        in `thresh`) separately for consecutive windows of
+        `thresh_window` miliseconds
 
     Returns
     -------
@@ -193,39 +900,197 @@ def detect_spikes(spike_data, thresh='auto', edge="rising",
 
     """ 
     
-    sp_data = spike_data['data'][contact, :]
-    n_contacts = spike_data['n_contacts']
-    
-    if filter is not None:
-        sp_data = filter(sp_data, spike_data['FS'])
-    #if n_contacts>1:
-    #    sp_data = sp_data[:,contact]
-
     FS = spike_data['FS']
+    
+    if chunksize is None:
+        sp_data = spike_data['data'][contact, :]
+        if filter is not None:
+            sp_data = filter(sp_data, FS)
+        filter_chunks = None
+        chunksize = len(sp_data)
+    else:
+        #rows of a 2D array are read lazily by the chunk iterator
+        sp_data = _ContactView(spike_data['data'], contact)
+        filter_chunks = filter
 
     if type(thresh) is str or type(thresh) is unicode:
-        
-        if thresh=='auto':
-            thresh_frac = 8
+        if thresh_method == 'std' and thresh_window is None:
+            thresh = _estimate_threshold(sp_data, thresh, FS, filter_chunks)
         else:
-            thresh_frac = float(thresh)
-            
-        thresh = thresh_frac*np.sqrt(float(np.var(sp_data[:int(10*FS)])))
+            thresh = estimate_threshold(spike_data, thresh, contact, filter,
+                                        method=thresh_method,
+                                        window=thresh_window)
         if edge == 'falling' or edge =="min":
             thresh = -thresh
     
-    if edge == "rising" or edge == "max":
-        i, = np.where((sp_data[:-1]<thresh) & (sp_data[1:]>thresh))
-    elif edge == "falling" or edge == "min":
-        i, = np.where((sp_data[:-1]>thresh) & (sp_data[1:]<thresh))
-    else:
-        raise TypeError("Edge must be 'rising' or 'falling'")
+    window = None
+    if thresh_window is not None:
+        window = max(int(thresh_window/1000.*FS), 1)
+    crossings = list(_iter_crossings(sp_data, thresh, edge, FS,
+                                     filter_chunks, max(chunksize, 1),
+                                     window=window))
+    i = np.concatenate(crossings) if crossings else np.array([], dtype=int)
     spt = i*1000./FS
 
     spt_dict = {'data': spt, 'thresh': thresh, 'contact': contact}
 
     return spt_dict
 
+def detect_spikes_multi(spike_data, thresh='auto', edge="rising",
+                        contacts='all', filter=None, tol=0.5,
+                        chunksize=None, thresh_method='std'):
+    r"""Detects spikes on several contacts at once.
+
+    Threshold crossings are found on all contacts in a single pass
+    over the data; crossings on any contact separated by less than
+    `tol` miliseconds from the previous one are merged into a single
+    event (as in :func:`remove_doubles`).
+
+    Parameters
+    ----------
+    spike_data : dict
+        extracellular waveforms
+    thresh : float, sequence or 'auto'
+        threshold for detection, common for all contacts or one per
+        contact. if thresh is 'auto' (or a string) it is estimated
+        separately for each contact (see :func:`detect_spikes`)
+    edge : {'rising', 'falling'}
+        which edge to trigger on
+    contacts : 'all' or sequence of int
+        contacts used for detection
+    filter : object, optional
+        filter used for spike detection; defaults to no filtering
+    tol : float
+        minimum interval between events in miliseconds; the event
+        peak is also searched in this interval after the crossing
+    chunksize : int, optional
+        if given, the recording is read (and filtered) in overlapping
+        segments of `chunksize` samples
+    thresh_method : {'std', 'mad'}
+        how the threshold is estimated (see :func:`detect_spikes`)
+
+    Returns
+    -------
+    spt_dict : dict
+        dictionary with 'data' key which contains the detected events
+        in miliseconds, 'thresh' with the threshold of each contact
+        and 'contact' with the contact with the largest peak of each
+        event
+    """
+
+    FS = spike_data['FS']
+    if contacts == 'all':
+        contacts = np.arange(spike_data['n_contacts'])
+    contacts = np.asarray(contacts)
+
+    if type(thresh) is str or type(thresh) is unicode:
+        thresh_est = []
+        for c in contacts:
+            if thresh_method == 'std':
+                sp_data = _ContactView(spike_data['data'], c)
+                t = _estimate_threshold(sp_data, thresh, FS, filter)
+            else:
+                t = estimate_threshold(spike_data, thresh, c, filter,
+                                       method=thresh_method)
+            thresh_est.append(t)
+        thresh = np.array(thresh_est)
+        if edge == 'falling' or edge =="min":
+            thresh = -thresh
+    thresh = np.ones(len(contacts))*thresh
+
+    sp_data = _ContactView(spike_data['data'], list(contacts))
+    if chunksize is None:
+        chunksize = len(sp_data)
+    n_tol = int(tol/1000.*FS)
+    crossings = list(_iter_crossings(sp_data, thresh[:, np.newaxis], edge,
+                                     FS, filter, max(chunksize, 1),
+                                     peak_len=n_tol))
+    if crossings:
+        i = np.concatenate([c[0] for c in crossings])
+        peak = np.concatenate([c[1] for c in crossings])
+    else:
+        i = np.array([], dtype=int)
+        peak = np.array([], dtype=int)
+
+    if len(i) > 0:
+        keep = np.concatenate(([True], np.diff(i) > n_tol))
+        i, peak = i[keep], peak[keep]
+    spt = i*1000./FS
+
+    spt_dict = {'data': spt, 'thresh': thresh, 'contact': contacts[peak]}
+
+    return spt_dict
+
+class OnlineDetector:
+    """Detect spikes in consecutive buffers of a recording.
+    
+    Crossings between buffers are detected (the last sample of the
+    previous buffer is kept) and the filter, if any, is applied
+    causally with the state carried over from the previous buffer.
+    
+    Parameters
+    ----------
+    thresh : float
+        threshold for detection
+    edge : {'rising', 'falling'}
+        which edge to trigger on
+    contact : int, optional
+        index of tetrode contact to use for detection
+    filter : object, optional
+        filter design (see :class:`CausalFilter`)
+    """
+    
+    def __init__(self, thresh, edge='rising', contact=0, filter=None):
+        if type(thresh) is str or type(thresh) is unicode:
+            raise TypeError("online detection requires a numeric threshold")
+        self.thresh = thresh
+        self.edge = edge
+        self.contact = contact
+        if filter is not None:
+            filter = CausalFilter(filter)
+        self.filter = filter
+        self.reset()
+    
+    def reset(self):
+        """Start a new recording"""
+        self._last = None
+        self._n_pts = 0
+        if self.filter is not None:
+            self.filter.reset()
+    
+    def __call__(self, spike_data):
+        """Detect spikes in the next buffer.
+        
+        Parameters
+        ----------
+        spike_data : dict
+            next buffer of the recording (see :ref:`raw_recording`)
+        
+        Returns
+        -------
+        spt_dict : dict
+            spike times in miliseconds from the start of the recording
+        """
+        FS = spike_data['FS']
+        sp_data = spike_data['data'][self.contact, :]
+        if self.filter is not None:
+            sp_data = self.filter(sp_data, FS)
+        
+        offset = self._n_pts
+        if self._last is not None:
+            sp_data = np.concatenate((self._last, sp_data))
+            offset -= 1
+        self._n_pts += len(sp_data)-(self._last is not None)
+        if len(sp_data) > 0:
+            self._last = sp_data[-1:]
+        
+        crossings = list(_iter_crossings(sp_data, self.thresh, self.edge, FS,
+                                         chunksize=max(len(sp_data), 1)))
+        i = np.concatenate(crossings) if crossings else np.array([], dtype=int)
+        spt = (i+offset)*1000./FS
+        
+        return {'data': spt, 'thresh': self.thresh, 'contact': self.contact}
+
 def filter_spt(spike_data, spt_dict, sp_win):
     spt = spt_dict['data']
     sp_data = spike_data['data']
@@ -245,8 +1110,73 @@ def filter_spt(spike_data, spt_dict, sp_win):
     return idx
     
 
+def _gather_spikes(sp_data, contacts, indices, win, spWave,
+                   batchsize=10000):
+    """Copy spike windows using a single fancy-indexing operation per
+    batch of spikes. Samples of windows reaching beyond the recording
+    are set to zero."""
+    
+    n_pts = sp_data.shape[1]
+    offsets = np.arange(win[0], win[1])[:, np.newaxis]
+    
+    for start in range(0, len(indices), batchsize):
+        stop = start+batchsize
+        #(n_pts, n_spikes) array of sample indices
+        idx = indices[start:stop] + offsets
+        valid = (idx>=0) & (idx<n_pts)
+        is_inner = valid.all()
+        if not is_inner:
+            np.clip(idx, 0, n_pts-1, out=idx)
+        for i, contact in enumerate(contacts):
+            waves = sp_data[contact].take(idx)
+            if not is_inner:
+                waves[~valid] = 0
+            spWave[:, start:stop, i] = waves
+
+def _read_spikes_blocked(sp_data, contacts, indices, win, spWave,
+                         blocksize=1E6):
+    """Copy spike windows from disk-based arrays (PyTables arrays, numpy
+    memmaps).
+    
+    Spikes are sorted by their position and grouped into blocks of
+    about `blocksize` samples (aligned to the chunks of PyTables
+    arrays), so that the data is read sequentially and only once. The
+    windows are then extracted from the blocks in memory and scattered
+    into `spWave` in the original spike order."""
+    
+    n_pts = sp_data.shape[1]
+    blocksize = int(blocksize)
+    chunkshape = getattr(sp_data, 'chunkshape', None)
+    if chunkshape is not None:
+        chunklen = chunkshape[-1]
+        blocksize = max(blocksize//chunklen, 1)*chunklen
+    
+    order = indices.argsort(kind='mergesort')
+    sorted_idx = indices[order]
+    
+    block_id = np.floor_divide(sorted_idx, blocksize)
+    bounds = np.nonzero(np.diff(block_id))[0]+1
+    bounds = np.concatenate(([0], bounds, [len(sorted_idx)]))
+    
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        if start == stop:
+            continue
+        l = max(sorted_idx[start]+win[0], 0)
+        r = min(sorted_idx[stop-1]+win[1], n_pts)
+        if l >= r:
+            #all windows outside of the recording (already zeroed)
+            continue
+        block = np.empty((len(contacts), r-l), dtype=spWave.dtype)
+        for i, contact in enumerate(contacts):
+            block[i, :] = sp_data[contact, l:r]
+        waves = np.empty((spWave.shape[0], stop-start, len(contacts)),
+                         dtype=spWave.dtype)
+        _gather_spikes(block, np.arange(len(contacts)),
+                       sorted_idx[start:stop]-l, win, waves)
+        spWave[:, order[start:stop], :] = waves
+
 def extract_spikes(spike_data, spt_dict, sp_win, resample=1,
-                   contacts='all'):
+                   contacts='all', out=None):
     """Extract spikes from recording.
 
     Parameters
@@ -257,15 +1187,33 @@ def extract_spikes(spike_data, spt_dict, sp_win, resample=1,
        spike times structure (see :ref:`spike_times`) 
     sp_win : list of int
        temporal extent of the wave shape 
+    out : str, optional
+       if given, the waveshapes are written to a file of this name
+       (in .npy format) instead of being kept in memory and `data` is a
+       memory-mapped array backed by this file; can not be combined
+       with (deprecated) `resample` (use :func:`resample_spikes` on the
+       waveshapes instead)
 
     Returns
     -------
     wavedict : dict
        spike waveforms structure (see :ref:`spike_wave`) 
 
+    Notes
+    -----
+    On disk the waveshapes are stored in spike-major layout (shape
+    (n_spikes, n_pts, n_contacts)), so that waveshapes of consecutive
+    spikes can be read in contiguous blocks; `data` is a transposed
+    view with the usual axes. The file can be opened again with::
+    
+        np.load(out, mmap_mode='r').transpose(1, 0, 2)
+
 
     """
 
+    if out is not None and resample != 1:
+        raise ValueError("resample can not be used together with out")
+
     sp_data = spike_data['data']
     n_contacts = spike_data['n_contacts']
     
@@ -278,36 +1226,34 @@ def extract_spikes(spike_data, spt_dict, sp_win, resample=1,
 
     FS = spike_data['FS']
     spt = spt_dict['data']
-    idx = np.arange(len(spt))
     inner_idx = filter_spt(spike_data, spt_dict, sp_win)
-    outer_idx = idx[np.in1d(idx, inner_idx) == False]
+    is_valid = np.zeros(len(spt), dtype=np.bool)
+    is_valid[inner_idx] = True
 
     indices = (spt/1000.*FS).astype(np.int32)
     win = (np.asarray(sp_win)/1000.*FS).astype(np.int32)
    
     time = np.arange(win[1]-win[0])*1000./FS+sp_win[0]
-    n_contacts, n_pts = sp_data.shape
     
-    #auxiliarly function to find a valid spike window within data range
-    minmax = lambda x: np.max([np.min([n_pts, x]), 0])
-
-   
-    spWave = np.zeros((len(time), len(spt), len(contacts)), 
-                      dtype=np.float32)
-    for i in inner_idx:
-        sp = indices[i]
-        spWave[:,i,:] = sp_data[contacts, sp+win[0]:sp+win[1]].T
-    for i in outer_idx:
-        sp = indices[i]
-        l, r = map(minmax, sp+win)
-        if l<>r:
-            spWave[(l-sp)-win[0]:(r-sp)-win[0],i,:] = sp_data[contacts, l:r].T
+    if out is None:
+        spWave = np.zeros((len(time), len(spt), len(contacts)), 
+                          dtype=np.float32)
+    else:
+        spWave = np.lib.format.open_memmap(out, mode='w+', 
+                                           dtype=np.float32,
+                                           shape=(len(spt), len(time),
+                                                  len(contacts)))
+        spWave = spWave.transpose(1, 0, 2)
+    if isinstance(sp_data, np.ndarray) and not isinstance(sp_data, np.memmap):
+        _gather_spikes(sp_data, contacts, indices, win, spWave)
+    else:
+        _read_spikes_blocked(sp_data, contacts, indices, win, spWave)
+    if out is not None:
+        spWave.flush()
 
     wavedict = {"data":spWave, "time": time, "FS": FS}
         
-    if len(idx) != len(inner_idx):
-        is_valid = np.zeros(len(spt), dtype=np.bool)
-        is_valid[inner_idx] = True
+    if not is_valid.all():
         wavedict['is_valid'] = is_valid
     
     if resample<>1:
@@ -319,8 +1265,43 @@ def extract_spikes(spike_data, spt_dict, sp_win, resample=1,
     
     return wavedict
 
-def resample_spikes(spikes_dict, FS_new):
-    """Upsample spike waveforms using spline interpolation"""
+def _spline_operator(time, resamp_time):
+    """Matrix of the spline interpolation from `time` to `resamp_time`.
+
+    Interpolating splines (s=0) are linear in the data, so the operator
+    is found by interpolating each of the unit vectors."""
+    
+    n_pts = len(time)
+    operator = np.empty((len(resamp_time), n_pts))
+    for i, unit in enumerate(np.eye(n_pts)):
+        tck = interpolate.splrep(time, unit, s=0)
+        operator[:, i] = interpolate.splev(resamp_time, tck, der=0)
+    return operator
+
+def resample_spikes(spikes_dict, FS_new, method='spline', dtype=np.float64,
+                    batchsize=10000):
+    """Upsample spike waveforms.
+    
+    Parameters
+    ----------
+    spikes_dict : dict
+        spike waveforms structure (see :ref:`spike_wave`)
+    FS_new : float
+        new sampling frequency
+    method : {'spline', 'fft'}, optional
+        'spline' uses cubic spline interpolation, 'fft' uses Fourier
+        method (assumes that the waveforms are periodic)
+    dtype : dtype, optional
+        data type of the returned waveforms (use float32 to save
+        memory)
+    batchsize : int, optional
+        number of spikes resampled at once
+
+    Returns
+    -------
+    spikes_dict : dict
+        resampled spike waveforms
+    """
 
     sp_waves = spikes_dict['data']
     time = spikes_dict['time']
@@ -328,22 +1309,79 @@ def resample_spikes(spikes_dict, FS_new):
 
     resamp_time = np.arange(time[0], time[-1], 1000./FS_new)
     n_pts, n_spikes, n_contacts = sp_waves.shape
+    n_resamp = len(resamp_time)
+
+    if method == 'spline':
+        operator = _spline_operator(time, resamp_time)
+        resample = lambda x: np.tensordot(operator, x, axes=(1, 0))
+    elif method == 'fft':
+        n_fft = int(np.round(n_pts*FS_new/FS))
+        resample = lambda x: signal.resample(x, n_fft, axis=0)[:n_resamp]
+    else:
+        raise ValueError("method must be either 'spline' or 'fft'")
 
-    spike_resamp = np.empty((len(resamp_time), n_spikes, n_contacts))
+    spike_resamp = np.empty((n_resamp, n_spikes, n_contacts), dtype=dtype)
 
-    for i in range(n_spikes):
-        for contact in range(n_contacts):
-            tck = interpolate.splrep(time, sp_waves[:, i, contact],s=0)
-            spike_resamp[:,i, contact] = interpolate.splev(resamp_time, tck, der=0)
+    for start in range(0, n_spikes, batchsize):
+        stop = start+batchsize
+        spike_resamp[:, start:stop, :] = resample(sp_waves[:, start:stop, :])
 
     return {"data":spike_resamp, "time":resamp_time, "FS":FS}
     
 
 
+def _align_iterative(spike_data, spt, idx_align, sp_win, type, resample,
+                     contact):
+    """Align spikes by repeated extraction of waveforms at the moved
+    spike markers (modifies `spt` in place)"""
+
+    #go in a loop until all spikes are correctly aligned
+    while len(idx_align) > 0:
+        spt_align = {'data': spt[idx_align]}
+        spt_inbound = filter_spt(spike_data, spt_align, sp_win)
+        idx_align = idx_align[spt_inbound]
+        sp_waves_dict = extract_spikes(spike_data, spt_align, sp_win,
+                                       contacts=contact)
+        if resample != 1:
+            sp_waves_dict = resample_spikes(sp_waves_dict,
+                                            spike_data['FS']*resample)
+        
+        sp_waves = sp_waves_dict['data'][:,spt_inbound,0]
+        time = sp_waves_dict['time']
+    
+        if type=="max":
+            i = sp_waves.argmax(0)
+        elif type=="min":
+            i = sp_waves.argmin(0)
+   
+        #move spike markers
+        shift = time[i]
+        spt[idx_align]+=shift
+    
+        #if spike maximum/minimum was at the edge we have to extract it at the
+        # new marker and repeat the alignment
+        tol = 0.1
+        idx_align = idx_align[(shift<(sp_win[0]+tol)) | (shift>(sp_win[1]-tol))]
+
+def _parabolic_peak(y):
+    """Sub-sample offset of the extremum of a parabola passing through
+    three equally spaced points (rows of `y`)"""
+    
+    denom = y[:, 0]-2*y[:, 1]+y[:, 2]
+    delta = np.zeros(len(y))
+    nonzero = denom != 0
+    delta[nonzero] = 0.5*(y[nonzero, 0]-y[nonzero, 2])/denom[nonzero]
+    return delta
+
 def align_spikes(spike_data, spt_dict, sp_win, type="max", resample=1,
-                contact=0, remove=True):
+                contact=0, remove=True, subsample=False):
     """Aligns spike waves and returns corrected spike times
     
+    Waveforms are extracted once in a window extended by the extent of
+    `sp_win` on both sides and the peak search is repeated in memory
+    for the spikes whose peak lies at the edge of the window. Only
+    spikes which move beyond the extended window are re-extracted.
+    
     Parameters
     ----------
     spike_data : dict
@@ -353,6 +1391,10 @@ def align_spikes(spike_data, spt_dict, sp_win, type="max", resample=1,
     resample : int, optional
     contact : int, optional
     remove : bool, optiona
+    subsample : bool, optional
+        if True, refine peak position by parabolic interpolation of
+        the peak and its two neighbouring samples (this is cheaper
+        than upsampling with `resample`)
 
     Returns
     -------
@@ -362,47 +1404,92 @@ def align_spikes(spike_data, spt_dict, sp_win, type="max", resample=1,
     """
 
     spt = spt_dict['data'].copy()
+    FS = spike_data['FS']
     
-    idx_align = np.arange(len(spt))
-    #spt_align = {'data': spt}
+    idx_align = filter_spt(spike_data, spt_dict, sp_win)
     
-    #go in a loop until all spikes are correctly aligned
-    iter_id = 0
-    while len(idx_align) > 0:
-        spt_align = {'data': spt[idx_align]}
-        spt_inbound = filter_spt(spike_data, spt_align, sp_win)
-        idx_align = idx_align[spt_inbound]
-        #spt_align = {'data': spt[idx_align]}
-        sp_waves_dict = extract_spikes(spike_data, spt_align, sp_win,
-                                       resample=resample, contacts=contact)
-        
-        sp_waves = sp_waves_dict['data'][:,spt_inbound,0]
-        #if sp_waves_dict.has_key('is_valid'):
-        #    sp_waves = sp_waves[:, sp_waves_dict['is_valid']]
-        time = sp_waves_dict['time']
+    #extract all spikes in a window wide enough to contain the window
+    #moved to either of its edges
+    wide_win = [sp_win[0]+min(sp_win[0], 0), sp_win[1]+max(sp_win[1], 0)]
+    sp_waves_dict = extract_spikes(spike_data, {'data': spt[idx_align]},
+                                   wide_win, contacts=contact)
+    if resample != 1:
+        sp_waves_dict = resample_spikes(sp_waves_dict, FS*resample)
+    sp_waves = sp_waves_dict['data'][:, :, 0]
+    time = sp_waves_dict['time']
+    
+    #number of samples in the alignment window (as in extract_spikes
+    #and resample_spikes)
+    win = (np.asarray(sp_win)/1000.*FS).astype(np.int32)
+    dt = 1000./(FS*resample)
+    n_win = win[1]-win[0]
+    if resample != 1:
+        n_win = len(np.arange(0, (n_win-1)*1000./FS, dt))
+    win_idx = np.arange(n_win)
     
+    #limits of inbound spike times (see filter_spt)
+    max_time = spike_data['data'].shape[1]*1000./FS
+    t_min = np.max((-sp_win[0], 0))
+    t_max = np.min((max_time, max_time-sp_win[1]))
+    
+    #first sample of the extended windows
+    wide_start = (np.asarray(wide_win)/1000.*FS).astype(np.int32)[0]
+    wide_start = (spt[idx_align]/1000.*FS).astype(np.int32)+wide_start
+    grid_start = wide_start*1000./FS
+    
+    tol = 0.1
+    shift_total = np.zeros(len(idx_align))
+    active = np.arange(len(idx_align))
+    outside = []
+    while len(active) > 0:
+        #first sample of the current window in the extended window
+        spt_cur = spt[idx_align[active]]+shift_total[active]
+        start = (spt_cur/1000.*FS).astype(np.int32)+win[0]
+        start = (start-wide_start[active])*resample
+        in_buffer = (start>=0) & (start+n_win<=len(time))
+        outside.append(active[~in_buffer])
+        active, start = active[in_buffer], start[in_buffer]
+        spt_cur = spt_cur[in_buffer]
+        
+        waves = sp_waves[start[:, np.newaxis]+win_idx, active[:, np.newaxis]]
         if type=="max":
-            i = sp_waves.argmax(0)
+            i = waves.argmax(1)
         elif type=="min":
-            i = sp_waves.argmin(0)
-   
-        #move spike markers
-        shift = time[i]
-        spt[idx_align]+=shift
+            i = waves.argmin(1)
+        
+        shift = sp_win[0]+i*dt
+        shift_total[active] += shift
+        spt_cur += shift
+        
+        inbound = (spt_cur>=t_min) & (spt_cur<=t_max)
+        at_edge = (shift<(sp_win[0]+tol)) | (shift>(sp_win[1]-tol))
+        
+        if subsample:
+            #place the marker at the interpolated peak on the sampling
+            #grid of the extended window
+            done = ~at_edge & (i>0) & (i<n_win-1)
+            rows, = np.nonzero(done)
+            i_done = i[done][:, np.newaxis]
+            peak = waves[rows[:, np.newaxis], i_done+[-1, 0, 1]]
+            pos = start[done]+i[done]+_parabolic_peak(peak)
+            idx_done = active[done]
+            shift_total[idx_done] = (grid_start[idx_done]+pos*dt - 
+                                     spt[idx_align[idx_done]])
+        
+        active = active[at_edge & inbound]
     
-        #if spike maximum/minimum was at the edge we have to extract it at the
-        # new marker and repeat the alignment
-        tol = 0.1
-        idx_align = idx_align[(shift<(sp_win[0]+tol)) | (shift>(sp_win[1]-tol))]
-        iter_id +=1
-        #print "Align. iteration %d, remaining idx %d" % (iter_id, len(idx_align))
-        #print shift
+    spt[idx_align] += shift_total
+    
+    #spikes which moved beyond the extended window
+    if outside:
+        idx_outside = idx_align[np.concatenate(outside)]
+        _align_iterative(spike_data, spt, idx_outside, sp_win, type, 
+                         resample, contact)
     
     ret_dict = {'data':spt}
     
     if remove:
         #remove double spikes
-        FS = spike_data['FS']
         ret_dict = remove_doubles(ret_dict, 1000./FS)
 
 
@@ -16,6 +16,7 @@ Each of the function returns a (mapping) object with following keys:
 
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy.special import ndtr
 
 def split_cells(features, idx, which='all'):
     """return the spike features splitted into separate cells"""
@@ -75,13 +76,18 @@ def select_spikes(features, idx):
         new_feats['is_valid'] = features['is_valid'][idx]
     return new_feats
 
-def combine(args, norm=True):
+def combine(args, norm=True, dtype=np.float32):
     """Combine features into a single structure
     
     Parameters
     ----------
     args : tuple or list of dict
         a tuple of feature data structures
+    norm : bool or str, optional
+        normalize the combined features; True means 'minmax' scaling,
+        other scalings can be given by name (see :py:func:`normalize`)
+    dtype : numpy dtype, optional
+        type of the combined feature array
     
     Returns
     -------
@@ -94,20 +100,29 @@ def combine(args, norm=True):
     #get mask, if it exist
     mask = [d['is_valid'] for d in args if 'is_valid' in d]
     
-    try:
-        if mask:
-            #combine masks using AND
-            mask = reduce(np.logical_and, mask)
-        data  = np.hstack(features)
-    except ValueError:
+    if mask:
+        #combine masks using AND
+        mask = reduce(np.logical_and, mask)
+    
+    n_spikes = len(features[0])
+    if any(len(f) != n_spikes for f in features):
         raise ValueError, 'all features must contain the same number of spikes'
     
+    #copy features to a single preallocated array
+    data = np.empty((n_spikes, sum(f.shape[1] for f in features)), 
+                    dtype=dtype)
+    col = 0
+    for f in features:
+        data[:, col:col+f.shape[1]] = f
+        col += f.shape[1]
+    
     combined_features = {"data": data,
                          "names":np.concatenate(names)}
     if list(mask): combined_features["is_valid"] = mask
     
     if norm:
-        normalize(combined_features, copy=False)
+        method = 'minmax' if norm is True else norm
+        normalize(combined_features, copy=False, method=method)
 
     
     return combined_features
@@ -126,22 +141,133 @@ def add_mask(feature_function):
     
     
 
-def normalize(features, copy=True):
-    """Normalize features"""
+def _scaling(data, method='minmax', blocksize=100000):
+    """Offset and scale of each column of `data` calculated in blocks
+    of rows; columns of zero spread get unit scale"""
+    n_obs, n_cols = data.shape
+    blocks = [slice(i, i+blocksize) for i in range(0, n_obs, blocksize)]
+    
+    if method == 'minmax':
+        offset = np.empty(n_cols)
+        offset.fill(np.inf)
+        high = -offset
+        for sl in blocks:
+            offset = np.minimum(offset, data[sl].min(0))
+            high = np.maximum(high, data[sl].max(0))
+        scale = high-offset
+    elif method == 'zscore':
+        #combine mean and sum of squared deviations of the blocks
+        n, offset, m2 = 0, np.zeros(n_cols), np.zeros(n_cols)
+        for sl in blocks:
+            block = np.asarray(data[sl], dtype=np.float64)
+            n_b = len(block)
+            mean_b = block.mean(0)
+            m2_b = ((block-mean_b)**2).sum(0)
+            delta = mean_b-offset
+            offset = offset + delta*n_b/(n+n_b)
+            m2 = m2 + m2_b + delta**2*n*n_b/(n+n_b)
+            n += n_b
+        scale = np.sqrt(m2/n)
+    elif method == 'robust':
+        #median and median absolute deviation (scaled to be consistent
+        #with standard deviation for normal data), column by column
+        offset, scale = np.empty(n_cols), np.empty(n_cols)
+        for j in range(n_cols):
+            column = np.asarray(data[:, j], dtype=np.float64)
+            offset[j] = np.median(column)
+            scale[j] = 1.4826*np.median(np.abs(column-offset[j]))
+    else:
+        raise ValueError("unknown normalization method %s" % method)
+    
+    scale[~(scale > 0)] = 1
+    return offset, scale
+
+def normalize(features, copy=True, method='minmax', blocksize=100000):
+    """Normalize features
+    
+    Parameters
+    ----------
+    features : dict
+        features data structure
+    copy : bool, optional
+        if False, the features (of floating point type) are normalized
+        in place
+    method : {'minmax', 'zscore', 'robust'}, optional
+        scaling of features: to the range [0, 1] ('minmax'), to zero 
+        mean and unit standard deviation ('zscore') or to zero median 
+        and unit (normalised) median absolute deviation ('robust');
+        constant features are set to 0
+    blocksize : int, optional
+        number of spikes processed at once
+    
+    Returns
+    -------
+    features_norm : dict
+    """
     if copy:
         features_norm = features.copy()
     else:
         features_norm = features
         
     data = features_norm['data']
-    data = (data-data.min(0)[np.newaxis,:])
-    data = data/data.max(0)[np.newaxis,:]
+    if not np.issubdtype(data.dtype, np.floating):
+        data = data.astype(np.float64)
+    elif copy:
+        data = data.copy()
+    
+    offset, scale = _scaling(data, method, int(blocksize))
+    data -= offset.astype(data.dtype)
+    data /= scale.astype(data.dtype)
     
     features_norm['data'] = data
 
     return features_norm    
 
-def PCA(data,ncomps=2):
+def _batched_cov(data, batchsize=10000):
+    """Mean and covariance of the columns (observations) of `data`,
+    accumulated over batches of `batchsize` observations (`data` can
+    be any array-like object that supports slicing, e.g. a PyTables
+    array)"""
+    n_vars, n_obs = data.shape
+    batchsize = int(batchsize)
+    total = np.zeros(n_vars)
+    for start in range(0, n_obs, batchsize):
+        batch = np.asarray(data[:, start:start+batchsize], dtype=np.float64)
+        total += batch.sum(1)
+    mean = total/n_obs
+    
+    cov = np.zeros((n_vars, n_vars))
+    for start in range(0, n_obs, batchsize):
+        batch = np.asarray(data[:, start:start+batchsize], dtype=np.float64)
+        batch = batch-mean[:, np.newaxis]
+        cov += np.dot(batch, batch.T)
+    cov /= max(n_obs-1, 1)
+    return mean, cov
+
+def _randomized_pcs(data, ncomps, n_oversample=10, n_iter=2, seed=None):
+    """Leading eigenvalues and eigenvectors of the covariance of `data`
+    by randomized truncated SVD of the (implicitly) centred data"""
+    n_vars, n_obs = data.shape
+    n_rand = min(ncomps+n_oversample, n_vars)
+    mean = data.mean(1)
+    
+    #products with the centred data computed without centring a copy
+    dot = lambda y: np.dot(data, y)-np.outer(mean, y.sum(0))
+    dot_t = lambda y: np.dot(data.T, y)-np.dot(mean, y)[np.newaxis, :]
+    
+    rng = np.random.RandomState(seed)
+    q = dot(rng.randn(n_obs, n_rand).astype(data.dtype))
+    for i in range(n_iter):
+        q, _ = np.linalg.qr(q)
+        q = dot(dot_t(q))
+    q, _ = np.linalg.qr(q)
+    b = dot_t(q).T
+    u, sv, _ = np.linalg.svd(b, full_matrices=False)
+    evecs = np.dot(q, u)
+    evals = sv**2/max(n_obs-1, 1)
+    return evals, evecs
+
+def PCA(data, ncomps=2, method='eigh', batchsize=10000, seed=None):
     """Perfrom a principle component analysis.
 
     Parameters
@@ -151,6 +277,27 @@ def PCA(data,ncomps=2):
         (n_vars, n_obs) array where `n_vars` is the number of
         variables (vector dimensions) and `n_obs` the number of
         observations
+    ncomps : int
+        number of components on which the data are projected
+    method : {'eigh', 'svd', 'randomized', 'incremental', 'eig'}
+        how the principal components are calculated:
+        
+        * 'eigh' -- eigendecomposition of the covariance matrix
+        * 'svd' -- singular value decomposition of the centred data
+          (more accurate, but slower for many observations)
+        * 'randomized' -- randomized truncated SVD (fast when `ncomps`
+          is much smaller than `n_vars`); only `ncomps` components are
+          returned
+        * 'incremental' -- covariance accumulated over batches of
+          `batchsize` observations, so that `data` can be a disk-based
+          (e.g. PyTables) array that does not fit into memory
+        * 'eig' -- general eigendecomposition (the original
+          implementation)
+    batchsize : int
+        number of observations processed at once in 'incremental'
+        method and in the projection
+    seed : int, optional
+        seed of the random number generator of 'randomized' method
 
     Returns
     -------
@@ -160,21 +307,69 @@ def PCA(data,ncomps=2):
         sorted eigenvectors
     score : array
         projection of the data on `ncomps` components
+
+    Notes
+    -----
+    The sign of each eigenvector is chosen so that its largest
+    (absolute) coefficient is positive. The data are projected in
+    their own floating point precision (float64 for integer data).
      """
 
-    #norm=data/np.std(data,1)[:,np.newaxis]
-    #norm[np.isnan(norm)]=0
-    #norm = data
-    data = data.astype(np.float64)
-    K=np.cov(data)
-    evals,evecs=np.linalg.eig(K)
-    order=np.argsort(evals)[::-1]
-    evecs=np.real(evecs[:,order])
-    evals=np.abs(evals[order])
-    score= np.dot(evecs[:,:ncomps].T,data)
-    score = score/np.sqrt(evals[:ncomps, np.newaxis])
+    evals, evecs = _pcs(data, ncomps, method, batchsize, seed)
+    proj = (evecs[:, :ncomps]/np.sqrt(evals[:ncomps])).T
+    score = _project(proj, data, batchsize)
     return evals,evecs,score
 
+def _pcs(data, ncomps, method='eigh', batchsize=10000, seed=None):
+    """Sorted eigenvalues and eigenvectors of the covariance of `data`
+    (see :py:func:`PCA`)"""
+    
+    if method == 'incremental':
+        _, K = _batched_cov(data, batchsize)
+    else:
+        data = np.asarray(data)
+        if not np.issubdtype(data.dtype, np.floating):
+            data = data.astype(np.float64)
+    
+    if method == 'eig':
+        K = np.cov(data)
+        evals, evecs = np.linalg.eig(K)
+        evecs, evals = np.real(evecs), np.abs(evals)
+    elif method in ('eigh', 'incremental'):
+        if method == 'eigh':
+            K = np.cov(data)
+        evals, evecs = np.linalg.eigh(K)
+    elif method == 'svd':
+        centred = data-data.mean(1)[:, np.newaxis]
+        evecs, sv, _ = np.linalg.svd(centred, full_matrices=False)
+        evals = sv**2/max(data.shape[1]-1, 1)
+    elif method == 'randomized':
+        evals, evecs = _randomized_pcs(data, ncomps, seed=seed)
+        #oversampled components are not accurate
+        evals, evecs = evals[:ncomps], evecs[:, :ncomps]
+    else:
+        raise ValueError("unknown PCA method %s" % method)
+    
+    order = np.argsort(evals)[::-1]
+    evals, evecs = np.maximum(evals[order], 0), evecs[:, order]
+    i_max = np.abs(evecs).argmax(0)
+    evecs = evecs*np.sign(evecs[i_max, np.arange(evecs.shape[1])])
+    return evals, evecs
+
+def _project(proj, data, batchsize=10000):
+    """Project columns of `data` with matrix `proj` in batches (in the
+    floating point precision of the data)"""
+    dtype = data.dtype if np.issubdtype(data.dtype, np.floating) \
+            else np.float64
+    proj = np.asarray(proj, dtype=dtype)
+    n_obs = data.shape[1]
+    batchsize = int(batchsize)
+    score = np.empty((proj.shape[0], n_obs), dtype=dtype)
+    for start in range(0, n_obs, batchsize):
+        batch = np.asarray(data[:, start:start+batchsize], dtype=dtype)
+        score[:, start:start+batchsize] = np.dot(proj, batch)
+    return score
+
 def _get_data(spk_dict, contacts):
     spikes = spk_dict["data"]
     if not contacts=="all":
@@ -186,8 +381,148 @@ def _get_data(spk_dict, contacts):
                              " contact indices" )
     return spikes
 
+class PCAModel:
+    """Principal components of spike waveshapes.
+    
+    Components are calculated separately for each contact or, if
+    `joint` is True, jointly for waveshapes of all contacts
+    concatenated (a single decomposition which also captures the
+    correlations between contacts).
+    
+    The model is fitted once (possibly on a sample of spikes) and can
+    be then applied to any number of spikes, so that features of
+    different subsets or recording sessions are calculated in the same
+    basis. The model can be stored in a HDF5 file with
+    :py:meth:`spike_sort.io.filters.PyTablesFilter.write_pca`.
+    
+    Parameters
+    ----------
+    ncomps : int, optional
+        number of components to retain
+    contacts : 'all' or list of int, optional
+        contacts to use
+    method : str, optional
+        PCA backend (see :py:func:`PCA`)
+    joint : bool, optional
+        calculate components of concatenated waveshapes of all
+        contacts
+    """
+    
+    def __init__(self, ncomps=2, contacts='all', method='eigh', joint=False):
+        self.ncomps = ncomps
+        self.contacts = contacts
+        self.method = method
+        self.joint = joint
+        self.components = None
+        self.evals = None
+    
+    def fit(self, spikes_data, max_spikes=None, seed=None):
+        """Calculate principal components of the spikes.
+        
+        Parameters
+        ----------
+        spikes_data : dict
+            spike waveshapes (see :ref:`spike_wave`)
+        max_spikes : int, optional
+            if given, the components are calculated from a random
+            sample of `max_spikes` spikes
+        seed : int, optional
+            seed of the random number generator
+        
+        Returns
+        -------
+        self : PCAModel
+        """
+        spikes = _get_data(spikes_data, self.contacts)
+        if spikes.ndim == 2:
+            spikes = spikes[:, :, np.newaxis]
+        n_spikes = spikes.shape[1]
+        if max_spikes is not None and max_spikes < n_spikes:
+            rng = np.random.RandomState(seed)
+            idx = np.sort(rng.permutation(n_spikes)[:max_spikes])
+            spikes = spikes[:, idx, :]
+        
+        n_pts, n_spikes, n_channels = spikes.shape
+        if self.joint:
+            stacked = spikes.transpose(2, 0, 1).reshape(n_channels*n_pts,
+                                                        n_spikes)
+            data = [stacked]
+        else:
+            data = [spikes[:, :, i] for i in range(n_channels)]
+        
+        components, evals = [], []
+        for x in data:
+            _evals, evecs = _pcs(x, self.ncomps, self.method, seed=seed)
+            _evals = _evals[:self.ncomps]
+            components.append((evecs[:, :self.ncomps]/np.sqrt(_evals)).T)
+            evals.append(_evals)
+        
+        if self.joint:
+            #split the joint components into parts for each contact
+            components = components[0].reshape(-1, n_channels, n_pts)
+            components = components.transpose(1, 0, 2)
+        self.components = np.array(components)
+        self.evals = np.array(evals)
+        return self
+    
+    def transform(self, spikes_data, batchsize=10000):
+        """Project spikes on the principal components.
+        
+        Parameters
+        ----------
+        spikes_data : dict
+            spike waveshapes (see :ref:`spike_wave`)
+        batchsize : int, optional
+            number of spikes projected at once
+        
+        Returns
+        -------
+        features : dict
+        """
+        if self.components is None:
+            raise ValueError("PCA model must be fitted first")
+        spikes = _get_data(spikes_data, self.contacts)
+        if spikes.ndim == 2:
+            spikes = spikes[:, :, np.newaxis]
+        n_channels, ncomps, n_pts = self.components.shape
+        if spikes.shape[2] != n_channels or spikes.shape[0] != n_pts:
+            raise ValueError("spike waveshapes do not match the model")
+        
+        sc = [_project(self.components[i], spikes[:, :, i], batchsize)
+              for i in range(n_channels)]
+        if self.joint:
+            sc = np.sum(sc, 0).T
+            names = ["PC%d" % i for i in range(ncomps)]
+        else:
+            #order features by component and then by channel
+            sc = np.array(sc).transpose(2, 1, 0).reshape(-1, 
+                                                         ncomps*n_channels)
+            names = ["Ch%d:PC%d" % (j,i) for i in range(ncomps) for j in
+                    range(n_channels)]
+        
+        features = {'data': sc, "names":names}
+        if 'is_valid' in spikes_data:
+            features['is_valid'] = spikes_data['is_valid']
+        return features
+    
+    def to_dict(self):
+        """Model parameters as a dictionary of arrays and scalars"""
+        return {'components': self.components, 'evals': self.evals,
+                'ncomps': self.ncomps, 'contacts': self.contacts, 
+                'method': self.method, 'joint': self.joint}
+    
+    @classmethod
+    def from_dict(cls, params):
+        """Create model from parameters returned by :py:meth:`to_dict`"""
+        model = cls(params['ncomps'], params['contacts'], params['method'],
+                    bool(params.get('joint', False)))
+        model.components = np.asarray(params['components'])
+        model.evals = np.asarray(params['evals'])
+        return model
+
 @add_mask
-def fetPCs(spikes_data,ncomps=2, contacts='all'):
+def fetPCs(spikes_data,ncomps=2, contacts='all', method='eigh', model=None,
+           joint=False):
     """Calculate principal components (PCs).
     
     Parameters
@@ -195,33 +530,153 @@ def fetPCs(spikes_data,ncomps=2, contacts='all'):
     spikes : dict
     ncomps : int, optional
         number of components to retain
+    method : str, optional
+        PCA backend (see :py:func:`PCA`)
+    model : PCAModel, optional
+        previously fitted model; if given the spikes are projected on
+        its components (`ncomps`, `contacts`, `method` and `joint` are
+        ignored)
+    joint : bool, optional
+        calculate `ncomps` components of concatenated waveshapes of
+        all contacts instead of `ncomps` components for each contact
      
     Returns
     -------
     features : dict
     
     """
-
-    spikes = _get_data(spikes_data, contacts)
-    def _getPCs(data):
-        _, _, sc=PCA(data[:,:],ncomps)
-        return sc
-
-    if spikes.ndim==3:
-        n_channels = spikes.shape[2]
-        sc=[]
-        for i in range(n_channels):
-            sc+=[_getPCs(spikes[:,:,i])]
-        sc=np.vstack(sc)
+    
+    if model is None:
+        model = PCAModel(ncomps, contacts, method, joint).fit(spikes_data)
+    return model.transform(spikes_data)
+
+#decomposition low-pass filters of orthogonal wavelets
+_WAVELETS = {
+    'haar': [0.7071067811865476, 0.7071067811865476],
+    'db2': [-0.12940952255092145, 0.22414386804185735, 
+            0.836516303737469, 0.48296291314469025],
+    'db4': [-0.010597401784997278, 0.032883011666982945, 
+            0.030841381835986965, -0.18703481171888114, 
+            -0.02798376941698385, 0.6308807679295904, 
+            0.7148465705525415, 0.23037781330885523]
+    }
+
+def _dwt_step(x, wavelet):
+    """Single level of periodized discrete wavelet transform along the
+    first axis; odd-length signals are extended by the last sample"""
+    if len(x) % 2:
+        x = np.concatenate((x, x[-1:]))
+    h = np.asarray(_WAVELETS[wavelet])
+    g = h[::-1]*(-1)**np.arange(len(h))
+    n = len(x)
+    idx = (2*np.arange(n//2)[:, np.newaxis]+np.arange(len(h))) % n
+    x = x[idx]
+    return np.tensordot(h, x, axes=(0, 1)), np.tensordot(g, x, axes=(0, 1))
+
+def _dwt_matrix(n_pts, wavelet='haar', levels=4):
+    """Matrix of a multilevel discrete wavelet transform of signals of
+    length `n_pts` (coefficients are ordered from the coarsest
+    approximation to the finest details)"""
+    if wavelet not in _WAVELETS:
+        raise ValueError("wavelet must be one of %s" % 
+                         ", ".join(sorted(_WAVELETS)))
+    approx = np.eye(n_pts)
+    details = []
+    for i in range(levels):
+        if len(approx) < 2:
+            break
+        approx, detail = _dwt_step(approx, wavelet)
+        details.insert(0, detail)
+    return np.vstack([approx]+details)
+
+def _ks_normality(data):
+    """Kolmogorov-Smirnov distance between distribution of each column
+    of `data` (standardised) and the normal distribution. Constant
+    columns carry no information and get distance 0."""
+    n_obs = data.shape[0]
+    std = data.std(0)
+    constant = std <= 1E-6*std.max()
+    std[constant] = 1
+    z = np.sort((data-data.mean(0))/std, axis=0)
+    cdf = ndtr(z)
+    ecdf = np.arange(1, n_obs+1)[:, np.newaxis]*1./n_obs
+    ks = np.maximum((ecdf-cdf).max(0), (cdf-ecdf+1./n_obs).max(0))
+    ks[constant] = 0
+    return ks
+
+def _select_wavelets(spikes, ncomps, wavelet, levels, max_spikes, seed):
+    """DWT matrix and indices (channel, coefficient) of the `ncomps`
+    least normal wavelet coefficients (see :py:func:`fetWavelet`)"""
+    n_pts, n_spikes, n_channels = spikes.shape
+    dtype = spikes.dtype if np.issubdtype(spikes.dtype, np.floating) \
+            else np.float64
+    dwt = _dwt_matrix(n_pts, wavelet, levels).astype(dtype)
+    
+    #select coefficients on a sample of spikes
+    if max_spikes is not None and max_spikes < n_spikes:
+        rng = np.random.RandomState(seed)
+        idx = np.sort(rng.permutation(n_spikes)[:max_spikes])
+        sample = spikes[:, idx, :]
     else:
-        sc=_getPCs(spikes)
-        n_channels = 1
-    sc=np.asarray(sc).T
+        sample = spikes
+    coefs = np.tensordot(dwt, sample, axes=(1, 0))
+    coefs = coefs.transpose(1, 2, 0).reshape(sample.shape[1], -1)
+    ks = _ks_normality(coefs)
+    selected = np.argsort(ks)[::-1][:ncomps]
+    channel, coef = selected//len(dwt), selected % len(dwt)
+    return dwt, channel, coef
+
+def _wavelet_coefs(spikes, dwt, channel, coef):
+    """Calculate only the selected wavelet coefficients of all spikes"""
+    data = np.empty((spikes.shape[1], len(coef)), dtype=dwt.dtype)
+    for i in range(spikes.shape[2]):
+        is_channel = channel == i
+        if is_channel.any():
+            data[:, is_channel] = np.dot(spikes[:, :, i].T, 
+                                         dwt[coef[is_channel]].T)
+    return data
+
+@add_mask
+def fetWavelet(spikes_data, ncomps=10, contacts='all', wavelet='haar', 
+               levels=4, max_spikes=10000, seed=None):
+    """Calculate wavelet coefficients of spike waveshapes.
+    
+    The discrete wavelet transform of all spikes and contacts is
+    calculated at once (as a matrix product). The `ncomps`
+    coefficients whose distributions deviate most from the normal
+    distribution (largest Kolmogorov-Smirnov distance), which are
+    likely to be multimodal, are returned.
     
-    names = ["Ch%d:PC%d" % (j,i) for i in range(ncomps) for j in
-            range(n_channels)]
+    Parameters
+    ----------
+    spikes_data : dict
+    ncomps : int, optional
+        number of coefficients to retain
+    contacts : 'all' or list of int, optional
+        contacts to use
+    wavelet : {'haar', 'db2', 'db4'}, optional
+        wavelet (periodized transform)
+    levels : int, optional
+        number of decomposition levels
+    max_spikes : int, optional
+        coefficients are selected on a random sample of at most
+        `max_spikes` spikes
+    seed : int, optional
+        seed of the random number generator used for sampling
+    
+    Returns
+    -------
+    features : dict
+    """
     
-    return {'data': sc, "names":names}
+    spikes = _get_data(spikes_data, contacts)
+    if spikes.ndim == 2:
+        spikes = spikes[:, :, np.newaxis]
+    dwt, channel, coef = _select_wavelets(spikes, ncomps, wavelet, levels,
+                                          max_spikes, seed)
+    data = _wavelet_coefs(spikes, dwt, channel, coef)
+    names = ["Ch%d:W%d" % (c, k) for c, k in zip(channel, coef)]
+    return {'data': data, 'names': names}
 
 @add_mask
 def fetP2P(spikes_data, contacts='all'):
@@ -293,23 +748,208 @@ def fetSpProjection(spikes_data, labels, cell_id=1):
     labels : array
         array of length equal to number of spikes that contains 
         cluster labels
-    cell_id : int
-        label of cell on which all spikes should be projected.
+    cell_id : int, list of int or 'all'
+        label(s) of cell(s) on which all spikes should be projected.
+    
+    Returns
+    -------
+    features : dict
+        normalised projection coefficients on the averaged waveform
+        of each cell and each contact (ordered by cell and then by
+        contact)
     
     Notes
     -----
     `labels` can be also a boolean array in which case only spikes for 
     which label is True value will be averaged to determine projection
     coefficient
+    
+    Projections on all cells are calculated at once as a product of
+    the templates matrix and the waveforms (one per contact).
     """ 
     
     spikes = spikes_data["data"]
+    cells, templates = _templates(spikes, labels, cell_id)
+    projection = _projection(spikes, templates)
     
-    proj_matrix = np.mean(spikes[:, labels==cell_id, :],1)
-    projection = (proj_matrix[:,np.newaxis,:]*spikes).sum(0)
-    projection /= np.sqrt((spikes**2).sum(0)*(proj_matrix**2).sum(0))
-    
-    ncomps = len(projection)
-    names = ["Ch%d:Proj" % i for i in range(ncomps)]
+    names = _projection_names(cells, cell_id, spikes.shape[2])
     return {'data': projection, 'names':names}
+
+def _projection_names(cells, cell_id, n_channels):
+    if not isinstance(cell_id, basestring) and np.ndim(cell_id) == 0:
+        return ["Ch%d:Proj" % i for i in range(n_channels)]
+    return ["Ch%d:Proj%d" % (j, int(cell)) for cell in cells 
+            for j in range(n_channels)]
+
+def _templates(spikes, labels, cell_id):
+    """Labels of cells and their averaged waveforms of shape
+    (n_cells, n_pts, n_contacts)"""
+    labels = np.asarray(labels)
+    if isinstance(cell_id, basestring):
+        cells = np.unique(labels)
+    elif np.ndim(cell_id) == 0:
+        cells = [cell_id]
+    else:
+        cells = list(cell_id)
+    templates = np.array([np.mean(spikes[:, labels==cell, :], 1) 
+                          for cell in cells])
+    return cells, templates
+
+def _projection(spikes, templates):
+    """Normalised projection of spikes on templates (on each contact);
+    returns array of shape (n_spikes, n_templates*n_contacts)"""
+    n_pts, n_spikes, n_channels = spikes.shape
+    n_cells = len(templates)
+    dtype = spikes.dtype if np.issubdtype(spikes.dtype, np.floating) \
+            else np.float64
+    templates = templates.astype(dtype)
+    t_norm = np.sqrt((templates**2).sum(1))
+    
+    projection = np.empty((n_spikes, n_cells, n_channels), dtype=dtype)
+    for i in range(n_channels):
+        x = np.asarray(spikes[:, :, i], dtype=dtype)
+        sp_norm = np.sqrt(np.einsum('ij,ij->j', x, x))
+        proj = np.dot(x.T, templates[:, :, i].T)
+        proj /= sp_norm[:, np.newaxis]*t_norm[:, i]
+        projection[:, :, i] = proj
+    return projection.reshape(n_spikes, n_cells*n_channels)
+
+def _n_channels(spikes_data, contacts):
+    if contacts == 'all':
+        return spikes_data['data'].shape[2]
+    return len(np.atleast_1d(contacts))
+
+def _block_P2P(spikes_data, contacts='all'):
+    names = ["Ch%d:P2P" % i for i in range(_n_channels(spikes_data, 
+                                                        contacts))]
+    def transform(block, sl):
+        block = _get_data({'data': block}, contacts)
+        p2p = block.max(axis=0)-block.min(axis=0)
+        if p2p.ndim<2:
+            p2p = p2p[:,np.newaxis]
+        return p2p
+    return names, transform
+
+def _block_SpIdx(spikes_data):
+    def transform(block, sl):
+        return np.arange(sl.start, sl.stop)[:, np.newaxis]
+    return ["SpIdx"], transform
+
+def _block_PCs(spikes_data, ncomps=2, contacts='all', method='eigh', 
+               model=None, joint=False):
+    if model is None:
+        model = PCAModel(ncomps, contacts, method, joint).fit(spikes_data)
+    #names do not depend on the data, so take them from a single spike
+    names = model.transform({'data': spikes_data['data'][:, :1, :]})['names']
+    def transform(block, sl):
+        return model.transform({'data': block})['data']
+    return names, transform
+
+def _block_Wavelet(spikes_data, ncomps=10, contacts='all', wavelet='haar',
+                   levels=4, max_spikes=10000, seed=None):
+    spikes = _get_data(spikes_data, contacts)
+    if spikes.ndim == 2:
+        spikes = spikes[:, :, np.newaxis]
+    dwt, channel, coef = _select_wavelets(spikes, ncomps, wavelet, levels,
+                                          max_spikes, seed)
+    names = ["Ch%d:W%d" % (c, k) for c, k in zip(channel, coef)]
+    def transform(block, sl):
+        block = _get_data({'data': block}, contacts)
+        if block.ndim == 2:
+            block = block[:, :, np.newaxis]
+        return _wavelet_coefs(block, dwt, channel, coef)
+    return names, transform
+
+def _block_SpProjection(spikes_data, labels, cell_id=1):
+    spikes = spikes_data['data']
+    cells, templates = _templates(spikes, labels, cell_id)
+    names = _projection_names(cells, cell_id, spikes.shape[2])
+    def transform(block, sl):
+        return _projection(block, templates)
+    return names, transform
+
+#features that can be calculated block by block: each function fits
+#the feature (if needed) and returns its names and a function 
+#transforming a block of waveshapes (and its slice of spike indices)
+_BLOCK_FEATURES = {'P2P': _block_P2P, 'SpIdx': _block_SpIdx,
+                   'PCs': _block_PCs, 'Wavelet': _block_Wavelet,
+                   'SpProjection': _block_SpProjection}
+
+def calc_features(spikes_data, methods, norm=True, blocksize=10000,
+                  dtype=np.float32, split=False):
+    """Calculate several features in a single pass over spike
+    waveshapes.
+    
+    Features which require fitting (PCs, Wavelet, SpProjection) are
+    fitted first. Then the waveshapes are traversed once in blocks of
+    `blocksize` spikes and all features of each block are written to a
+    single preallocated array. Features which can not be calculated
+    block-wise are calculated at once and copied to the array.
+    
+    Parameters
+    ----------
+    spikes_data : dict
+        spike waveshapes (see :ref:`spike_wave`)
+    methods : list of tuples
+        list of (name, args, kwargs) tuples, where name is a feature
+        name without the `fet` prefix, for example
+        ``[('P2P', (), {}), ('PCs', (), {'ncomps': 2})]``
+    norm : bool or str, optional
+        normalize features (see :py:func:`combine`)
+    blocksize : int, optional
+        number of spikes processed at once
+    dtype : numpy dtype, optional
+        type of the feature array
+    split : bool, optional
+        return a list of features of each method instead of the
+        combined features (their data are views of the same array and
+        are not normalized)
+    
+    Returns
+    -------
+    features : dict or list of dicts
+        combined features (as returned by :py:func:`combine`)
+    """
+    
+    spikes = spikes_data['data']
+    n_spikes = spikes.shape[1]
+    
+    names, transforms = [], []
+    for name, args, kwargs in methods:
+        if name in _BLOCK_FEATURES:
+            _names, transform = _BLOCK_FEATURES[name](spikes_data, *args, 
+                                                      **kwargs)
+        else:
+            feature = globals()["fet" + name](spikes_data, *args, **kwargs)
+            if len(feature['data']) != n_spikes:
+                raise ValueError('all features must contain the same '
+                                 'number of spikes')
+            _names = feature['names']
+            transform = lambda block, sl, data=feature['data']: data[sl]
+        names.append(_names)
+        transforms.append((len(_names), transform))
+    
+    data = np.empty((n_spikes, sum(n for n, _ in transforms)), dtype=dtype)
+    blocksize = int(blocksize)
+    for start in range(0, n_spikes, blocksize):
+        sl = slice(start, min(start+blocksize, n_spikes))
+        block = spikes[:, sl, :]
+        col = 0
+        for n, transform in transforms:
+            data[sl, col:col+n] = transform(block, sl)
+            col += n
+    
+    if split:
+        bounds = np.cumsum([0]+[n for n, _ in transforms])
+        return [{'data': data[:, start:stop], 'names': fet_names} 
+                for start, stop, fet_names in zip(bounds[:-1], bounds[1:], 
+                                                  names)]
+    
+    features = {'data': data, 'names': np.concatenate(names)}
+    if 'is_valid' in spikes_data:
+        features['is_valid'] = spikes_data['is_valid']
+    if norm:
+        method = 'minmax' if norm is True else norm
+        normalize(features, copy=False, method=method)
+    return features
     
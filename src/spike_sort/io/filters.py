@@ -7,6 +7,9 @@ methods:
  * read_sp -- read raw spike waveforms 
  * write_sp -- write raw spike waveforms
 
+:class:`PyTablesFilter` can also store fitted PCA models (`write_pca`
+and `read_pca`).
+
 '''
 import os
 import numpy as np
@@ -377,6 +380,39 @@ class PyTablesFilter:
         arr_node[:] = sp
         
         arr_node.attrs['sampfreq']=sp_dict['FS']
+    
+    def write_pca(self, pca_model, dataset, overwrite=False):
+        """Write fitted PCA model (see
+        :py:class:`spike_sort.core.features.PCAModel`)"""
+        h5f = self.h5file
+        
+        params = pca_model.to_dict()
+        
+        parts = dataset.split('/')
+        group = '/'.join(parts[:-1])
+        node_name = parts[-1]
+    
+        if overwrite:
+            try:
+                h5f.removeNode(group, node_name)
+            except tables.exceptions.NodeError:
+                pass
+    
+        arr_node = h5f.createArray(group, node_name, params.pop('components'),
+                title="PCA model", createparents=True)
+        
+        for k, v in params.items():
+            arr_node.setAttr(k, v)
+    
+    def read_pca(self, dataset):
+        """Read PCA model written by :py:meth:`write_pca`"""
+        from spike_sort.core.features import PCAModel
+        
+        node = self.h5file.getNode(dataset)
+        params = self._get_attrs(node)
+        params['components'] = node.read()
+        return PCAModel.from_dict(params)
+    
     def close(self):
         if self.h5file:
             self.h5file.close()
@@ -1,4 +1,5 @@
 from spike_beans import base, components
+import spike_sort as ss
 from nose.tools import ok_,raises
 from nose import with_setup
 import numpy as np
@@ -153,6 +154,30 @@ def test_spike_detection_update():
     spt_new = detector.events
     ok_(len(spt_new['data'])==0)
 
+class NoisySignalSource(DummySignalSource):
+    """Spikes on the first of two contacts with gaussian noise"""
+    def __init__(self):
+        super(NoisySignalSource, self).__init__()
+        n_pts = self._spikes.shape[1]
+        noise = np.random.RandomState(0).randn(2, n_pts)*5
+        self._spikes = np.vstack((self._spikes, np.zeros((1, n_pts))))+noise
+
+    def read_signal(self):
+        return {"data":self._spikes, "n_contacts":2, "FS":self.FS}
+
+    signal = property(read_signal)
+
+@with_setup(setup, teardown)
+def test_spike_detection_whiten():
+    base.features.Provide("SignalSource", NoisySignalSource())
+    #threshold in units of the whitened noise
+    detector = components.SpikeDetector(thresh=8., whiten=True)
+    spt = detector.events
+
+    source = base.features['SignalSource']
+    ok_(len(spt['data'])==len(source.spt))
+    ok_((np.abs(spt['data']-source.spt)<=spike_dur).all())
+
 @with_setup(setup_io, teardown_io)
 def test_bakerlab_event_read():
     spt_fname = "32test0111.spt"
@@ -257,6 +282,127 @@ def test_feature_extractor():
     ok_((features['data']==spike_amp).all())       
 
 
+@with_setup(setup, teardown)
+def test_feature_extractor_cache():
+    base.features.Provide("SpikeSource",       DummySpikeSource())
+    
+    feat_comp = components.FeatureExtractor(normalize=False)
+    feat_comp.add_feature("P2P")
+    p2p = feat_comp.features['data']
+    cached = feat_comp._cache.values()[0]
+    
+    #adding a feature does not recalculate the others
+    feat_comp.add_feature("SpIdx")
+    features = feat_comp.features
+    ok_(list(features['names'])==["Ch0:P2P", "SpIdx"])
+    ok_((features['data'][:, :1]==p2p).all())
+    ok_(any(f is cached for f in feat_comp._cache.values()))
+    
+    #update with unchanged spikes does not recalculate features
+    feat_comp.update()
+    ok_(any(f is cached for f in feat_comp._cache.values()))
+    
+    #changed spikes invalidate the cache
+    base.features['SpikeSource']._sp_waves['data'] *= 2
+    feat_comp.update()
+    ok_((feat_comp.features['data'][:, 0]==2).all())
+    ok_(not any(f is cached for f in feat_comp._cache.values()))
+    
+    feat_comp.remove_feature("P2P")
+    ok_(list(feat_comp.features['names'])==["SpIdx"])
+    ok_(len(feat_comp._cache)==1)
+
+class RandomSpikeSource(base.Component):
+    def __init__(self):
+        data = np.random.RandomState(0).randn(30, n_spikes-2, 1)
+        self.spikes = {'data': data, 'time': np.arange(30)*1000./FS}
+        super(RandomSpikeSource, self).__init__()
+
+@with_setup(setup, teardown)
+def test_feature_extractor_cache_model():
+    base.features.Provide("SpikeSource",       RandomSpikeSource())
+    spikes = base.features['SpikeSource'].spikes
+    model = ss.features.PCAModel(ncomps=2)
+    model.fit({'data': spikes['data'][:, :50, :]})
+
+    feat_comp = components.FeatureExtractor(normalize=False)
+    feat_comp.add_feature("PCs", model=model)
+    pcs = feat_comp.features['data'].copy()
+
+    #refitted model invalidates the cached features
+    model.fit({'data': spikes['data'][:, 50:, :]})
+    feat_comp.update()
+    new_pcs = feat_comp.features['data']
+    ok_(not np.allclose(new_pcs, pcs))
+    ok_(np.allclose(new_pcs, model.transform(spikes)['data'], atol=1E-5))
+
+
+class ConstantLabelSource(base.Component):
+    def __init__(self):
+        self.labels = np.ones(n_spikes-2, dtype=int)
+        super(ConstantLabelSource, self).__init__()
+
+@with_setup(setup, teardown)
+def test_online_sorter():
+    base.features.Provide("SignalSource",      DummySignalSource())
+    base.features.Provide("SpikeMarkerSource", 
+                          components.SpikeDetector(thresh=50.))
+    base.features.Provide("SpikeSource",       components.SpikeExtractor())
+    base.features.Provide("LabelSource",       ConstantLabelSource())
+    base.features.Provide("BufferSource",      
+                          components.ReplaySource(realtime=False))
+    
+    sorter = components.OnlineSorter(thresh=50.)
+    sorter.run()
+    spt = sorter.events['data']
+    spt_batch = base.features['SpikeMarkerSource'].events['data']
+    
+    ok_(len(spt)==len(spt_batch))
+    ok_((np.abs(spt-spt_batch)<=1000./FS).all())
+    ok_((sorter.labels==1).all())
+    ok_(sorted(sorter.latency_percentiles().keys())==[50, 90, 99])
+
+class TwoCellSignalSource(DummySignalSource):
+    """Two cells firing alternately with pulses of different amplitude"""
+    def __init__(self):
+        super(TwoCellSignalSource, self).__init__()
+        n_pts = self._spikes.shape[1]
+        sp_idx = (np.arange(1,self.n_spikes-1)*self.period*FS/1000).astype(int)
+        self.cell_labels = np.arange(len(sp_idx)) % 2 + 1
+        spikes = np.zeros(n_pts)
+        spikes[sp_idx] = spike_amp*self.cell_labels
+        n = int(0.5/1000.*FS)
+        spikes = np.convolve(spikes, np.ones(n), 'full')[:n_pts]
+        self._spikes = spikes[np.newaxis, :]
+
+class TwoCellLabelSource(base.Component):
+    def __init__(self):
+        self.labels = base.features['SignalSource'].cell_labels
+        super(TwoCellLabelSource, self).__init__()
+
+def _sort_two_cells(f_filter):
+    base.features.Provide("SignalSource",      TwoCellSignalSource())
+    base.features.Provide("SpikeMarkerSource",
+                          components.SpikeDetector(thresh=50.))
+    base.features.Provide("SpikeSource",       components.SpikeExtractor())
+    base.features.Provide("LabelSource",       TwoCellLabelSource())
+    base.features.Provide("BufferSource",
+                          components.ReplaySource(realtime=False))
+
+    sorter = components.OnlineSorter(thresh=50., f_filter=f_filter)
+    sorter.run()
+
+    labels = base.features['LabelSource'].labels
+    ok_(len(sorter.labels)==len(labels))
+    ok_((sorter.labels==labels).all())
+
+@with_setup(setup, teardown)
+def test_online_sorter_two_cells():
+    _sort_two_cells(None)
+
+@with_setup(setup, teardown)
+def test_online_sorter_two_cells_filtered():
+    _sort_two_cells((300., 100.))
 
 @with_setup(setup, teardown)
 def test_cluster_component():
@@ -7,6 +7,10 @@ from numpy.testing import assert_array_almost_equal as almost_equal
 from numpy.testing import assert_allclose as allclose
 
 import warnings
+import tables
+import tempfile
+import shutil
+import os
 
 class TestExtract:
     
@@ -26,6 +30,191 @@ class TestExtract:
         ok_(self.spk_data['data'].shape == spk_filt['data'].shape)
         
     
+    def test_filter_proxy_parallel(self):
+        sp_freq = 1000./self.period
+        filter = ss.extract.Filter(sp_freq*0.5, sp_freq*0.4, 1, 10, 'ellip')
+        spk_data = self.spk_data.copy()
+        spk_data['data'] = np.repeat(self.spikes, 4, 0)
+        spk_data['n_contacts'] = 4
+        chunksize = self.spikes.shape[1]/4
+        spk_filt = ss.extract.filter_proxy(spk_data, filter, chunksize)
+        spk_filt_par = ss.extract.filter_proxy(spk_data, filter, chunksize,
+                                               n_jobs=3)
+        ok_((spk_filt['data'][:]==spk_filt_par['data'][:]).all())
+    
+    def test_filter_proxy_overlap(self):
+        #filtering in overlapping segments should match filtering of the
+        #whole signal
+        sp_freq = 1000./self.period
+        filter = ss.extract.Filter(sp_freq*0.5, sp_freq*0.4, 1, 10, 'ellip')
+        spk_data = self.spk_data.copy()
+        spk_data['data'] = self.spikes + np.random.randn(*self.spikes.shape)
+        chunksize = self.spikes.shape[1]/10
+        spk_filt = ss.extract.filter_proxy(spk_data, filter, chunksize,
+                                           overlap='auto')
+        ref = filter(spk_data['data'][0, :], self.FS)
+        allclose(spk_filt['data'][0, :], ref, atol=1E-6)
+    
+    def test_filter_proxy_lazy(self):
+        sp_freq = 1000./self.period
+        filter = ss.extract.Filter(sp_freq*0.5, sp_freq*0.4, 1, 10, 'ellip')
+        spk_data = self.spk_data.copy()
+        spk_data['data'] = np.repeat(self.spikes, 2, 0)
+        spk_data['data'] += np.random.randn(*spk_data['data'].shape)
+        spk_data['n_contacts'] = 2
+        spk_filt = ss.extract.filter_proxy(spk_data, filter, lazy=True)
+        ok_(isinstance(spk_filt['data'], ss.extract.FilteredArray))
+        sp_filt = ss.extract.FilteredArray(spk_data['data'], filter, self.FS,
+                                           blocksize=1000)
+        ref = filter(spk_data['data'][1, :], self.FS)
+        allclose(sp_filt[1, 2500:7300], ref[2500:7300], atol=1E-6)
+        allclose(sp_filt[:, 999][1], ref[999], atol=1E-6)
+        ok_(sp_filt[:, ::2].shape == (2, self.spikes.shape[1]/2))
+    
+    def test_filter_sos(self):
+        sp_freq = 1000./self.period
+        noise = np.random.RandomState(0).randn(self.spikes.shape[1])
+        x = self.spikes[0, :] + noise
+        filter = ss.extract.Filter(sp_freq*0.5, sp_freq*0.4, 1, 10, 'ellip')
+        filter_sos = ss.extract.Filter(sp_freq*0.5, sp_freq*0.4, 1, 10, 'ellip',
+                                       output='sos', dtype=np.float32)
+        y = filter(x, self.FS)
+        y_sos = filter_sos(x, self.FS)
+        ok_(y_sos.dtype == np.float32)
+        #float32 precision relative to the signal amplitude
+        allclose(y_sos, y, atol=1E-3*np.abs(y).max())
+    
+    def test_filter_fir_fft(self):
+        from scipy import signal
+        sp_freq = 1000./self.period
+        x = self.spikes[0, :] + np.random.randn(self.spikes.shape[1])
+        filter = ss.extract.FilterFir(sp_freq*0.5, sp_freq*0.4, 200)
+        b, a = filter._design_filter(self.FS)
+        allclose(filter(x, self.FS), signal.filtfilt(b, a, x), atol=1E-10)
+    
+    def test_causal_filter_buffers(self):
+        from scipy import signal
+        sp_freq = 1000./self.period
+        x = self.spikes + np.random.randn(*self.spikes.shape)
+        filter = ss.extract.Filter(sp_freq*0.5, sp_freq*0.4, 1, 10, 'ellip')
+        online = ss.extract.CausalFilter(filter)
+        n_buf = int(0.01*self.FS)
+        y = [online(x[:, i:i+n_buf], self.FS)
+             for i in range(0, x.shape[1], n_buf)]
+        b, a = filter._design_filter(self.FS)
+        y_full, _ = signal.lfilter(b, a, x,
+                                   zi=signal.lfilter_zi(b, a)*x[:, :1])
+        allclose(np.hstack(y), y_full, atol=1E-10)
+    
+    def test_online_detect(self):
+        sp_freq = 1000./self.period
+        self.spk_data['data'] += 2
+        filter = ss.extract.Filter(sp_freq*0.5, sp_freq*0.4, 1, 10, 'ellip')
+        detector = ss.extract.OnlineDetector(0.5, filter=filter)
+        data = self.spk_data['data']
+        n_buf = int(0.01*self.FS)
+        spt = [detector({'data': data[:, i:i+n_buf], 'FS': self.FS})['data']
+               for i in range(0, data.shape[1], n_buf)]
+        spt_full = ss.extract.detect_spikes(self.spk_data, thresh=0.5,
+                        filter=ss.extract.CausalFilter(filter))
+        ok_(len(spt_full['data']) == self.n_spikes)
+        allclose(np.concatenate(spt), spt_full['data'])
+    
+    def test_estimate_threshold_mad(self):
+        rng = np.random.RandomState(0)
+        noise = rng.randn(int(20*self.FS))
+        noise[::100] += 20
+        spk_data = {'data': noise[np.newaxis, :], 'FS': self.FS,
+                    'n_contacts': 1}
+        thresh = ss.extract.estimate_threshold(spk_data, 5.)
+        thresh_rnd = ss.extract.estimate_threshold(spk_data, 5., 
+                                            sampling='random', seed=1)
+        ok_(np.abs(thresh-5)<0.25)
+        ok_(np.abs(thresh_rnd-5)<0.25)
+    
+    def test_detect_adaptive_threshold(self):
+        rng = np.random.RandomState(0)
+        n_pts = int(20*self.FS)
+        noise = rng.randn(n_pts)
+        noise[n_pts/2:] *= 4
+        spk_data = {'data': noise[np.newaxis, :], 'FS': self.FS,
+                    'n_contacts': 1}
+        spt = ss.extract.detect_spikes(spk_data, thresh='auto', 
+                                       thresh_method='mad',
+                                       thresh_window=10000.)
+        spt_fixed = ss.extract.detect_spikes(spk_data, thresh=5.)
+        ok_(len(spt['thresh'])==2)
+        ok_(np.abs(spt['thresh'][1]/spt['thresh'][0]-4)<0.2)
+        ok_(len(spt['data']) < len(spt_fixed['data']))
+
+    def test_detect_window_scalar_threshold(self):
+        spt = ss.extract.detect_spikes(self.spk_data, thresh=0.5,
+                                       thresh_window=100.)
+        spt_fixed = ss.extract.detect_spikes(self.spk_data, thresh=0.5)
+        allclose(spt['data'], spt_fixed['data'])
+
+    def test_detect_multi(self):
+        #the same spikes on four contacts, largest on the third one
+        gains = np.array([0.6, 0.8, 1., 0.7])[:, np.newaxis]
+        spk_data = {'data': self.spikes*gains, 'FS': self.FS,
+                    'n_contacts': 4}
+        spt = ss.extract.detect_spikes_multi(spk_data, thresh=0.5, tol=2.)
+        spt_single = ss.extract.detect_spikes(spk_data, thresh=0.5, contact=2)
+        ok_(len(spt['data'])==self.n_spikes)
+        ok_((np.abs(spt['data']-spt_single['data'])<=1000./self.FS).all())
+        ok_((spt['contact']==2).all())
+    
+    def test_detect_multi_chunked(self):
+        sp_freq = 1000./self.period
+        filter = ss.extract.Filter(sp_freq*0.5, sp_freq*0.4, 1, 10, 'ellip')
+        data = np.vstack((self.spikes, -self.spikes))+2
+        spk_data = {'data': data, 'FS': self.FS, 'n_contacts': 2}
+        spt = ss.extract.detect_spikes_multi(spk_data, thresh=[0.5, 0.5],
+                                             filter=filter)
+        spt_chunked = ss.extract.detect_spikes_multi(spk_data, 
+                                        thresh=[0.5, 0.5], filter=filter,
+                                        chunksize=data.shape[1]/7)
+        ok_(len(spt['data'])==2*self.n_spikes)
+        allclose(spt['data'], spt_chunked['data'])
+        ok_((spt['contact']==spt_chunked['contact']).all())
+    
+    def test_whitening_signal(self):
+        rng = np.random.RandomState(0)
+        mixing = np.array([[1., 0.8, 0.5], [0., 1., 0.3], [0., 0., 1.]])
+        n_pts = int(5*self.FS)
+        data = np.dot(mixing, rng.randn(3, n_pts))
+        sp_idx = np.arange(100, n_pts-100, 500)
+        data[:, sp_idx] += 50
+        spk_data = {'data': data, 'FS': self.FS, 'n_contacts': 3}
+        spt = {'data': sp_idx*1000./self.FS}
+        
+        whitening = ss.extract.Whitening().fit(spk_data, spt, [-0.2, 0.8])
+        white = whitening.whiten_signal(spk_data, chunksize=n_pts/3)
+        noise = np.delete(white['data'][:], sp_idx, axis=1)
+        allclose(np.cov(noise), np.eye(3), atol=0.05)
+        
+        waves = ss.extract.extract_spikes(spk_data, spt, [-0.2, 0.8])
+        white_waves = whitening.whiten_spikes(waves)
+        ok_(white_waves['data'].shape == waves['data'].shape)
+        allclose(white_waves['data'][5, 1, :], 
+                 np.dot(whitening.W, waves['data'][5, 1, :]), rtol=1E-5)
+    
+    def test_whitening_temporal(self):
+        from scipy import signal
+        rng = np.random.RandomState(1)
+        n_pts = int(20*self.FS)
+        data = signal.lfilter([1.], [1., -0.9], rng.randn(2, n_pts))
+        spk_data = {'data': data, 'FS': self.FS, 'n_contacts': 2}
+        sp_win = [-0.2, 0.2]
+        whitening = ss.extract.Whitening(temporal=True).fit(spk_data, 
+                                                            sp_win=sp_win)
+        spt = {'data': np.arange(1, 20000, 7.)}
+        waves = whitening.whiten_spikes(
+                    ss.extract.extract_spikes(spk_data, spt, sp_win))
+        n_wave, n_spikes, _ = waves['data'].shape
+        x = waves['data'].swapaxes(0, 1).reshape(n_spikes, -1)
+        allclose(np.cov(x, rowvar=0), np.eye(2*n_wave), atol=0.15)
+    
     def test_detect(self):
         n_spikes = self.n_spikes
         period = self.period
@@ -48,7 +237,30 @@ class TestExtract:
         filter = ss.extract.Filter(sp_freq*0.5, sp_freq*0.4, 1, 10, 'ellip')
         spt = ss.extract.detect_spikes(self.spk_data, thresh=threshold, filter=filter)
         ok_(len(spt['data'])==n_spikes)
-        
+
+    def test_detect_chunked(self):
+        #chunked detection should give identical results to the
+        #in-memory one also for crossings at the chunk boundaries
+        threshold = 0.5
+        spt = ss.extract.detect_spikes(self.spk_data, thresh=threshold)
+        chunksize = int(self.period/12.*self.FS/1000.)
+        spt_chunked = ss.extract.detect_spikes(self.spk_data, thresh=threshold,
+                                               chunksize=chunksize)
+        ok_((spt['data']==spt_chunked['data']).all())
+
+    def test_filter_detect_chunked(self):
+        sp_freq = 1000./self.period
+        self.spk_data['data']+=2
+        filter = ss.extract.Filter(sp_freq*0.5, sp_freq*0.4, 1, 10, 'ellip')
+        spt = ss.extract.detect_spikes(self.spk_data, thresh='1',
+                                       filter=filter)
+        spt_chunked = ss.extract.detect_spikes(self.spk_data, thresh='1',
+                                               filter=filter,
+                                               chunksize=self.period*self.FS/1000.)
+        almost_equal(spt['thresh'], spt_chunked['thresh'])
+        ok_(len(spt['data'])==self.n_spikes)
+        ok_((spt['data']==spt_chunked['data']).all())
+
     def test_align(self):
         #check whether spikes are correctly aligned to maxima
         maxima_idx = self.period*(1/4.+np.arange(self.n_spikes))
@@ -79,6 +291,17 @@ class TestExtract:
         last = spt['data'][-1]     
         ok_((last>=(self.time[-1]-sp_win[1])) & (last<=self.time[-1]))
     
+    def test_align_subsample(self):
+        #peak interpolation should be more precise than the sampling
+        #period
+        maxima_idx = self.period*(1/4.+np.arange(self.n_spikes))
+        thr_crossings = self.period*(1/6. + np.arange(self.n_spikes))
+        spt_dict = {"data":thr_crossings}
+        sp_win = [-self.period/24., self.period/12.]
+        spt = ss.extract.align_spikes(self.spk_data, spt_dict, sp_win,
+                                      subsample=True)
+        ok_((np.abs(spt['data']-maxima_idx)<=0.1*1000./self.FS).all())
+    
     def test_align_double_spikes(self):
         #double detections of the same spike should be removed
         maxima_idx = self.period*(1/4.+np.arange(self.n_spikes))
@@ -120,6 +343,29 @@ class TestExtract:
         ref_sp = np.sin(2*np.pi/self.period*sp_resamp['time'])
         ok_((np.abs(ref_sp[:,np.newaxis]-sp_resamp['data'][:,:,0])<1E-6).all())
         
+    def test_resample_batched(self):
+        #batched resampling should agree with per-spike interpolation
+        from scipy import interpolate
+        time = np.arange(20)*1000./self.FS
+        waves = np.random.randn(20, 5, 2)
+        sp_waves = {"data": waves, "time": time, "FS": self.FS}
+        sp_resamp = ss.extract.resample_spikes(sp_waves, self.FS*3)
+        tck = interpolate.splrep(time, waves[:, 3, 1], s=0)
+        ref_sp = interpolate.splev(sp_resamp['time'], tck)
+        almost_equal(sp_resamp['data'][:, 3, 1], ref_sp)
+
+    def test_extract_and_resample_fft(self):
+        zero_crossing = self.period*np.arange(self.n_spikes)
+        zero_crossing += 1000./self.FS/2.
+        spt_dict = {"data":zero_crossing}
+        sp_win = [0, self.period]
+        sp_waves = ss.extract.extract_spikes(self.spk_data, spt_dict, sp_win)
+        sp_resamp = ss.extract.resample_spikes(sp_waves, self.FS*2, 
+                                               method='fft', dtype=np.float32)
+        ref_sp = np.sin(2*np.pi/self.period*sp_resamp['time'])
+        ok_(sp_resamp['data'].dtype == np.float32)
+        ok_((np.abs(ref_sp[:,np.newaxis]-sp_resamp['data'][:,:,0])<1E-5).all())
+        
     def test_mask_of_truncated_spikes(self):
         zero_crossing = self.period*np.arange(self.n_spikes+1)
         spt_dict = {"data":zero_crossing}
@@ -148,6 +394,92 @@ class TestExtract:
         ref_sp[:len(ref_sp)/2] = 0
         almost_equal(sp_waves['data'][:,0,0],ref_sp)
         
+    def test_extract_from_array_like(self):
+        #vectorised and per-spike extraction should give the same result
+        class ArrayLike(object):
+            def __init__(self, data):
+                self.data = data
+                self.shape = data.shape
+            def __getitem__(self, s):
+                return self.data[s]
+        spt_dict = {"data": self.period*np.arange(-1, self.n_spikes+1)}
+        sp_win = [-self.period/4., self.period/2.]
+        sp_waves = ss.extract.extract_spikes(self.spk_data, spt_dict, sp_win)
+        spk_data = self.spk_data.copy()
+        spk_data['data'] = ArrayLike(self.spk_data['data'])
+        sp_waves_ref = ss.extract.extract_spikes(spk_data, spt_dict, sp_win)
+        ok_((sp_waves['data']==sp_waves_ref['data']).all())
+        ok_((sp_waves['is_valid']==sp_waves_ref['is_valid']).all())
+        
+    def test_extract_from_hdf5(self):
+        spt_dict = {"data": self.period*np.arange(-1, self.n_spikes+1)}
+        sp_win = [-self.period/4., self.period/2.]
+        sp_waves = ss.extract.extract_spikes(self.spk_data, spt_dict, sp_win)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'test.h5')
+            h5f = tables.openFile(fname, 'w')
+            try:
+                atom = tables.Atom.from_dtype(self.spikes.dtype)
+                carray = h5f.createCArray('/', 'raw', atom, self.spikes.shape,
+                                          chunkshape=(1, 128))
+                carray[:] = self.spikes
+                spk_data = self.spk_data.copy()
+                spk_data['data'] = carray
+                sp_waves_h5 = ss.extract.extract_spikes(spk_data, spt_dict, 
+                                                        sp_win)
+            finally:
+                h5f.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        ok_((sp_waves['data']==sp_waves_h5['data']).all())
+        
+    def test_extract_to_disk(self):
+        spt_dict = {"data": self.period*np.arange(-1, self.n_spikes+1)}
+        sp_win = [-self.period/4., self.period/2.]
+        sp_waves = ss.extract.extract_spikes(self.spk_data, spt_dict, sp_win)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'spikes.npy')
+            sp_waves_disk = ss.extract.extract_spikes(self.spk_data, spt_dict,
+                                                      sp_win, out=fname)
+            ok_(isinstance(sp_waves_disk['data'], np.memmap))
+            ok_((sp_waves['data']==sp_waves_disk['data']).all())
+            
+            #block-wise consumers give the same results
+            ok_(np.allclose(ss.evaluate.snr_spike(sp_waves_disk),
+                            ss.evaluate.snr_spike(sp_waves)))
+            methods = [('P2P', (), {})]
+            ok_((ss.features.calc_features(sp_waves_disk, methods, 
+                                           blocksize=3)['data'] ==
+                 ss.features.calc_features(sp_waves, methods)['data']).all())
+            
+            #close the memmap before reopening the file
+            sp_waves_disk['data'].flush()
+            del sp_waves_disk
+            reopened = np.load(fname, mmap_mode='r').transpose(1, 0, 2)
+            ok_((sp_waves['data']==reopened).all())
+            del reopened
+        finally:
+            shutil.rmtree(tmpdir)
+    
+    @raises(ValueError)
+    def test_extract_to_disk_resample(self):
+        spt_dict = {"data": self.period*np.arange(1, self.n_spikes)}
+        sp_win = [-self.period/4., self.period/2.]
+        ss.extract.extract_spikes(self.spk_data, spt_dict, sp_win, 
+                                  resample=2, out='spikes.npy')
+        
+    def test_remove_spikes(self):
+        spt_data = np.random.rand(1000)*1000
+        remove_data = np.random.rand(100)*1000
+        tolerance = [-0.5, 1.]
+        spt = ss.extract.remove_spikes({'data': spt_data}, 
+                                       {'data': remove_data}, tolerance)
+        dist = spt_data[:, np.newaxis]-remove_data[np.newaxis, :]
+        is_close = ((dist>=tolerance[0]) & (dist<=tolerance[1])).any(1)
+        ok_((spt['data']==spt_data[~is_close]).all())
+        
     def test_filter_spt(self):
         #out of band spikes  should be removed
         zero_crossing = self.period*(np.arange(self.n_spikes))
@@ -219,6 +551,21 @@ class TestFeatures:
         ok_(error<0.01)
 
 
+    def test_PCA_methods(self):
+        rng = np.random.RandomState(0)
+        n_dim, n_obs = 20, 500
+        mixing = rng.randn(n_dim, n_dim)*np.logspace(1, -1, n_dim)
+        data = np.dot(mixing, rng.randn(n_dim, n_obs))
+        
+        evals, evecs, score = ss.features.PCA(data, 3, method='eig')
+        for method in ['eigh', 'svd', 'randomized', 'incremental']:
+            _evals, _evecs, _score = ss.features.PCA(data, 3, method=method,
+                                                     batchsize=64, seed=1)
+            allclose(_evals[:3], evals[:3], rtol=1E-6)
+            allclose(_score, score, atol=1E-6)
+        #randomized method returns only the requested components
+        ok_(ss.features.PCA(data, 3, method='randomized')[0].shape == (3,))
+    
     def test_fetPC(self):
         spikes_dict = self.spikes_dict.copy()
         n_spikes = 200
@@ -239,6 +586,92 @@ class TestFeatures:
 
         eq_(n_spikes, correct)
         
+    def test_pca_model(self):
+        rng = np.random.RandomState(0)
+        n_spikes = 300
+        amps = rng.rand(n_spikes, 2, 2)
+        spikes = np.einsum('ick,cp->pik', amps, self.cells.astype(float))
+        spikes += rng.randn(*spikes.shape)
+        spikes_dict = {'data': spikes, 'time': self.spikes_dict['time']}
+        
+        model = ss.features.PCAModel(ncomps=2).fit(spikes_dict)
+        pcs = ss.features.fetPCs(spikes_dict, ncomps=2)
+        pcs_model = ss.features.fetPCs(spikes_dict, model=model)
+        allclose(pcs_model['data'], pcs['data'])
+        ok_(pcs_model['names'] == ['Ch0:PC0', 'Ch1:PC0', 'Ch0:PC1', 'Ch1:PC1'])
+        
+        #projection on a model fitted to a subset of spikes
+        sub_model = ss.features.PCAModel(ncomps=2).fit(spikes_dict, 
+                                                       max_spikes=100, seed=1)
+        sub_pcs = sub_model.transform(spikes_dict, batchsize=64)
+        ok_(sub_pcs['data'].shape == (n_spikes, 4))
+        first = {'data': spikes[:, :10, :]}
+        allclose(sub_model.transform(first)['data'], sub_pcs['data'][:10])
+    
+    def test_fetPCs_joint(self):
+        rng = np.random.RandomState(0)
+        spikes = rng.randn(30, 200, 4)
+        spikes_dict = {'data': spikes}
+        pcs = ss.features.fetPCs(spikes_dict, ncomps=3, joint=True)
+        
+        stacked = spikes.transpose(2, 0, 1).reshape(120, 200)
+        _, _, score = ss.features.PCA(stacked, 3)
+        allclose(pcs['data'], score.T, atol=1E-10)
+        ok_(pcs['names'] == ['PC0', 'PC1', 'PC2'])
+    
+    def test_fetWavelet(self):
+        rng = np.random.RandomState(0)
+        n_spikes = 400
+        labels = rng.rand(n_spikes) > 0.5
+        cells = self.cells.astype(float)
+        spikes = cells[labels.astype(int), :].T[:, :, np.newaxis]
+        spikes = spikes + rng.randn(*spikes.shape)*10
+        spikes_dict = {'data': spikes, 'is_valid': np.ones(n_spikes, bool)}
+        
+        wavelets = ss.features.fetWavelet(spikes_dict, ncomps=3)
+        ok_(wavelets['data'].shape == (n_spikes, 3))
+        ok_(len(wavelets['names']) == 3)
+        ok_('is_valid' in wavelets)
+        
+        #the most multimodal coefficient separates the cells
+        coef = wavelets['data'][:, 0]
+        threshold = (coef.max()+coef.min())/2.
+        ok_(((coef > threshold) == labels).all() or 
+            ((coef > threshold) == ~labels).all())
+    
+    def test_calc_features(self):
+        rng = np.random.RandomState(0)
+        n_spikes = 250
+        labels = rng.rand(n_spikes) > 0.5
+        spikes = self.cells.astype(float)[labels.astype(int), :].T
+        spikes = spikes[:, :, np.newaxis] + rng.randn(100, n_spikes, 2)*10
+        spikes_dict = {'data': spikes}
+        
+        methods = [('P2P', (), {}), ('SpIdx', (), {}), 
+                   ('PCs', (), {'ncomps': 2}), 
+                   ('SpProjection', (labels,), {'cell_id': True})]
+        fused = ss.features.calc_features(spikes_dict, methods, 
+                                          blocksize=100)
+        feats = [ss.features.__getattribute__("fet" + name)(spikes_dict, 
+                                                            *args, **kwargs)
+                 for name, args, kwargs in methods]
+        combined = ss.features.combine(feats)
+        
+        ok_(fused['data'].dtype == np.float32)
+        ok_((fused['names'] == combined['names']).all())
+        ok_(np.allclose(fused['data'], combined['data'], atol=1E-5))
+
+    def test_calc_features_scalar_contact(self):
+        spikes = np.random.randn(100, 50, 2)
+        spikes_dict = {'data': spikes}
+        fused = ss.features.calc_features(spikes_dict,
+                                          [('P2P', (), {'contacts': 0})],
+                                          norm=False)
+        p2p = ss.features.fetP2P(spikes_dict, contacts=0)
+
+        ok_(fused['data'].shape == (50, 1))
+        ok_(np.allclose(fused['data'], p2p['data']))
+
     def test_getSpProjection(self):
         spikes_dict = self.spikes_dict.copy()
         cells = spikes_dict['data']
@@ -248,6 +681,18 @@ class TestFeatures:
         feat = ss.features.fetSpProjection(spikes_dict, labels)
         ok_(((feat['data'][:,0]>0.5) == labels).all())
         
+        #projections on all cells at once
+        feat_all = ss.features.fetSpProjection(spikes_dict, labels, 'all')
+        ok_(list(feat_all['names']) == ['Ch0:Proj0', 'Ch0:Proj1'])
+        ok_(np.allclose(feat_all['data'][:, 1], feat['data'][:, 0]))
+        ok_(((feat_all['data'][:,0]>0.5) == (labels==0)).all())
+
+        #boolean labels and unicode cell_id give clean names
+        feat_bool = ss.features.fetSpProjection(spikes_dict, labels==1,
+                                                u'all')
+        ok_(list(feat_bool['names']) == ['Ch0:Proj0', 'Ch0:Proj1'])
+        ok_(np.allclose(feat_bool['data'], feat_all['data']))
+        
     def test_add_mask_decorator(self):
         spikes_dict = {'data':np.zeros((10,2)), 
                        'is_valid':np.zeros(2, )}
@@ -282,6 +727,30 @@ class TestFeatures:
                     'is_valid':mask2}
         combined = ss.features.combine((feature1, feature2))
         ok_((combined['is_valid']==(mask1 & mask2)).all())   
+    
+    def test_normalize_methods(self):
+        rng = np.random.RandomState(0)
+        data = np.vstack((rng.randn(1000)*5+3, np.ones(1000))).T
+        features = {'data': data.astype(np.float32), 'names': ['a', 'b']}
+        
+        minmax = ss.features.normalize(features)['data']
+        ok_(np.allclose(minmax.min(0), [0, 0]))
+        ok_(np.allclose(minmax.max(0), [1, 0]))
+        
+        zscore = ss.features.normalize(features, method='zscore', 
+                                       blocksize=300)['data']
+        ok_(np.allclose(zscore.mean(0), 0, atol=1E-5))
+        ok_(np.allclose(zscore[:, 0].std(), 1, atol=1E-5))
+        
+        robust = ss.features.normalize(features, method='robust')['data']
+        ok_(np.allclose(np.median(robust, 0), 0, atol=1E-5))
+        ok_(np.abs(robust[:, 0].std()-1) < 0.1)
+        ok_(np.isfinite(robust).all())
+        
+        #in place
+        ss.features.normalize(features, copy=False, method='zscore')
+        ok_(features['data'].dtype == np.float32)
+        ok_(np.allclose(features['data'], zscore))
         
 class TestCluster:
     """test clustering algorithms"""
@@ -321,6 +790,26 @@ class TestCluster:
         cl = ss.cluster.cluster('gmm', self.features, self.K)
         ok_(self._cmp_bin_partitions(cl, self.labels))
     
+    def test_match_templates(self):
+        n_pts, n_contacts = 20, 2
+        shapes = np.random.randn(n_pts, 2, n_contacts)*10
+        labels = np.repeat([3, 7], 50)
+        sp_data = (shapes[:, (labels==7).astype(int), :] + 
+                   np.random.randn(n_pts, len(labels), n_contacts))
+        spikes = {'data': sp_data, 'time': np.arange(n_pts)}
+        templates = ss.cluster.calc_templates(spikes, labels)
+        ok_((templates['labels']==[3, 7]).all())
+        ok_((ss.cluster.match_templates(spikes, templates)==labels).all())
+
+    @raises(ValueError)
+    def test_match_templates_empty(self):
+        n_pts = 20
+        spikes = {'data': np.random.randn(n_pts, 10, 1),
+                  'time': np.arange(n_pts)}
+        labels = np.zeros(10, dtype=int)
+        templates = ss.cluster.calc_templates(spikes, labels, exclude=[0])
+        ss.cluster.match_templates(spikes, templates)
+
     def test_random(self):
         cl = np.random.rand(len(self.labels))>0.5
         ok_(~self._cmp_bin_partitions(cl, self.labels))
@@ -67,6 +67,19 @@ class TestHDF:
         spt = self.filter.read_spt(self.cell_node)
         ok_((spt['data']==self.spt).all())
         
+    def test_write_read_pca(self):
+        spikes = {'data': np.random.randn(20, 50, 2)}
+        model = ss.features.PCAModel(ncomps=3).fit(spikes)
+        self.filter = PyTablesFilter(self.fname)
+        self.filter.write_pca(model, self.el_node+'/pca')
+        self.filter.close()
+        self.filter = PyTablesFilter(self.fname)
+        model_read = self.filter.read_pca(self.el_node+'/pca')
+        ok_(model_read.ncomps == 3)
+        ok_(model_read.contacts == 'all')
+        ok_((model_read.transform(spikes)['data'] == 
+             model.transform(spikes)['data']).all())
+        
 class TestBakerlab:
     def setup(self):
         file_descr = {"fspike":"{ses_id}{el_id}.sp",